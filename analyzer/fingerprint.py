@@ -0,0 +1,33 @@
+import cv2
+import numpy as np
+
+HASH_SIZE = 8  # 8x8 comparisons, 64 bit hash
+HISTOGRAM_BINS = 4  # bins per color channel, 64 bins in total
+
+
+class ImageFingerprinter:
+    """
+    Compact descriptors for near duplicate detection. Difference hash captures the structure of the
+    grayscale image and survives resizing and recompression, the coarse color histogram separates
+    images with the same structure but different colors
+    """
+
+    def __init__(self):
+        pass
+
+    def difference_hash(self, image) -> int:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        resized = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+        bits = resized[:, 1:] > resized[:, :-1]
+        return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+    def color_histogram(self, image) -> np.ndarray:
+        """
+        :return: uint8 array of HISTOGRAM_BINS ** 3 values, normalized to sum up to about 255
+        """
+        histogram = cv2.calcHist([image], [0, 1, 2], None, [HISTOGRAM_BINS] * 3, [0, 256] * 3).flatten()
+        histogram = histogram / max(histogram.sum(), 1) * 255
+        return np.round(histogram).astype(np.uint8)
+
+    def fingerprint(self, image):
+        return self.difference_hash(image), self.color_histogram(image)
@@ -3,8 +3,11 @@ from typing import List
 
 from analyzer.face_detector import FaceDetector
 from analyzer.face_identifier import FaceIdentifier
+from analyzer.fingerprint import ImageFingerprinter
+from analyzer.preview_generator import PreviewGenerator
 from analyzer.image_tagger import ImageTagger
 from image_store import Image, Face
+from image_store.thumbnail_store import PackedThumbnailStore, FACE_THUMBNAILS_FILE
 from old_illusion.protocol import AbstractWorker, Message
 
 
@@ -13,6 +16,9 @@ class ImageAnalyzer(AbstractWorker):
     face_extractor = None
     face_identifier = None
     image_tagger = None
+    fingerprinter = None
+    face_thumbnails = None
+    preview_generator = None
 
     class InboxTypes(Enum):
         ANALYZE_NEW_IMAGES = 1  # existing images arrived
@@ -22,25 +28,40 @@ class ImageAnalyzer(AbstractWorker):
         UPDATE_METADATA = 1  # sending discovered images
         FACES_IDENTIFIED = 2
 
-    def __init__(self, config, inbox_queue, outbox_queue):
+    def __init__(self, config, inbox_queue, outbox_queue, shared_memory_pool=None):
         self.config = config
         self.inbox_queue = inbox_queue
         self.outbox_queue = outbox_queue
+        self.shared_memory_pool = shared_memory_pool
         self.face_extractor = FaceDetector(self.config.face_extractor_model)
         self.image_tagger = ImageTagger()
         self.face_identifier = FaceIdentifier()
+        self.fingerprinter = ImageFingerprinter()
+        self.face_thumbnails = PackedThumbnailStore(self.config.face_thumbnails_loc.joinpath(FACE_THUMBNAILS_FILE))
+        self.preview_generator = PreviewGenerator(
+            self.config.thumbnails_loc, max_cache_size=self.config.preview_cache_mb * 1024 * 1024
+        )
 
     def image_analysis(self, images: List[Image]):
         for image in images:
             image_array = image.read_image_content()
+            # previews are made from the same decoded image, the original is not read again
+            self.preview_generator.generate(image.md5, image_array)
             if image.faces_detected is False:
                 self.detect_faces(image, image_array)
             if image.tags_detected is False:
                 self.detect_tags(image, image_array)
+            if image.fingerprinted is False:
+                self.compute_fingerprint(image, image_array)
         return images
 
     def detect_faces(self, image, image_array):
         faces = self.face_extractor.get_faces(image_array)
+        if self.shared_memory_pool is not None and len(faces) > 0:
+            # thumbnails of all faces of the image go to the image store in one shared segment
+            shared_thumbnails = self.shared_memory_pool.share([face.get_thumbnail() for face in faces])
+            for face, shared_thumbnail in zip(faces, shared_thumbnails):
+                face.share_thumbnail(shared_thumbnail)
         image.add_faces(faces)
         image.set_faces_detected_flag()
 
@@ -48,9 +69,12 @@ class ImageAnalyzer(AbstractWorker):
         image.add_tags(self.image_tagger.detect_tags(image_array))
         image.set_tags_detected_flag()
 
+    def compute_fingerprint(self, image, image_array):
+        image.set_fingerprint(*self.fingerprinter.fingerprint(image_array))
+
     def face_analysis(self, faces: List[Face]):
         for face in faces:
-            identity = self.face_identifier.add_to_index_and_identify(face.get_thumbnail())
+            identity = self.face_identifier.add_to_index_and_identify(face.get_thumbnail(self.face_thumbnails))
             face.set_person(identity)
             face.set_person_identified_flag()
         return faces
@@ -0,0 +1,92 @@
+import os
+from pathlib import Path
+
+import cv2
+
+PREVIEW_SIZES = (1024, 256)  # longest side in pixels, every preview is resized from the previous larger one
+PREVIEW_JPEG_QUALITY = 85
+EVICTION_TARGET = 0.9  # eviction removes least recently used previews until the cache is this full
+
+
+class PreviewGenerator:
+    """
+    Downscaled JPEG previews of images, stored under thumbnails_loc and keyed by md5, so copies of an image
+    share previews. Previews are created from the image already decoded for analysis. The total size of
+    the cache is bounded, previews that were not generated or read for the longest time are removed first
+    """
+
+    def __init__(self, previews_dir: Path, max_cache_size: int, sizes=PREVIEW_SIZES):
+        """
+        :param max_cache_size: bytes
+        """
+        self.previews_dir = Path(previews_dir)
+        self.max_cache_size = max_cache_size
+        self.sizes = sorted(sizes, reverse=True)
+        self._cache_size = sum(file_size for _, _, file_size in self._iter_previews())
+
+    def preview_path(self, md5, size) -> Path:
+        return self.previews_dir.joinpath(str(size), md5[:2], f"{md5}.jpeg")
+
+    def get_preview_path(self, md5, size):
+        """
+        :return: path of an existing preview, None if it was not generated or was evicted
+        """
+        path = self.preview_path(md5, size)
+        try:
+            # modification time marks the last use for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def generate(self, md5, image_array):
+        if image_array is None:
+            return
+        preview = image_array
+        for size in self.sizes:
+            height, width = preview.shape[:2]
+            scale = size / max(height, width)
+            if scale < 1:
+                preview = cv2.resize(
+                    preview, (max(round(width * scale), 1), max(round(height * scale), 1)),
+                    interpolation=cv2.INTER_AREA
+                )
+            path = self.preview_path(md5, size)
+            if path.is_file():
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp.jpeg")
+            cv2.imwrite(str(tmp_path), preview, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY])
+            os.replace(tmp_path, path)
+            self._cache_size += path.stat().st_size
+
+        if self._cache_size > self.max_cache_size:
+            self._evict()
+
+    def _iter_previews(self):
+        """
+        :return: generator of (path, modification time, size)
+        """
+        for size in self.sizes:
+            size_dir = self.previews_dir.joinpath(str(size))
+            if not size_dir.is_dir():
+                continue
+            for prefix_dir in os.scandir(size_dir):
+                if not prefix_dir.is_dir():
+                    continue
+                for entry in os.scandir(prefix_dir.path):
+                    if entry.is_file():
+                        entry_stat = entry.stat()
+                        yield entry.path, entry_stat.st_mtime, entry_stat.st_size
+
+    def _evict(self):
+        previews = sorted(self._iter_previews(), key=lambda preview: preview[1])
+        self._cache_size = sum(file_size for _, _, file_size in previews)
+        for path, _, file_size in previews:
+            if self._cache_size <= self.max_cache_size * EVICTION_TARGET:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._cache_size -= file_size
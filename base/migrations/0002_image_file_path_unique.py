@@ -0,0 +1,24 @@
+# Generated by Django 4.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        # the crawler used to insert every image again on each start, keep only the newest row for every path
+        migrations.RunSQL(
+            sql=("DELETE older FROM base_image AS older "
+                 "JOIN base_image AS newer ON newer.file_path = older.file_path AND newer.id > older.id"),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='file_path',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
@@ -3,7 +3,7 @@ from django.db import models
 
 class Image(models.Model):
 
-    file_path = models.CharField(max_length=100)
+    file_path = models.CharField(max_length=100, unique=True)
     last_modified_time = models.BigIntegerField()
     is_deleted = models.BooleanField(default=False)
 
@@ -1,55 +1,426 @@
 import asyncio
 import datetime
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from colorama import Fore
 
+from change_queues import Change, ChangeKind
+from crawl_snapshot import load_snapshot, save_snapshot
 from crawler_settings import CrawlerSettings
+from fs_watcher import InotifyWatcher, InotifyUnavailable, WatchLimitReached, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, \
+    IN_DELETE_SELF, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 
-tracked_images = {}  # path, detection_time, mod_time
+ImageStat = namedtuple('ImageStat', ['mod_time', 'size', 'inode', 'device'])
 
+# directory mtimes advance in coarse steps (a kernel tick locally, up to seconds on network mounts), a listing taken
+# within this window of the directory mtime may miss a file created in the same step and is not reused
+RACY_LISTING_WINDOW_NS = 2 * 10 ** 9
 
-def retrieve_images(search_dirs, ignore_dirs, extensions):
+tracked_images = {}  # path, detection_time, stat
+tracked_inodes = {}  # (device, inode), path
+scanned_dirs = {}  # dir path, (dir mod_time, listing time, image names, subdir names)
+snapshot_state = {'dirty': False, 'saved_at': 0.0}
+
+
+def _image_stat(stat_result):
+    return ImageStat(stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino, stat_result.st_dev)
+
+
+def _scan_dir(dir_path, extensions, listing_ttl):
+    """
+    Lists a single directory. With listing_ttl, the names listed by a previous pass are reused if the directory mtime
+    has not changed and the listing is less than listing_ttl seconds old. Files of a reused listing are not stat'ed,
+    their ImageStat is None. Listings of directories modified within RACY_LISTING_WINDOW_NS are never reused
+    :return: (dict of images found directly in the directory to ImageStat, subdirectories) or None if the directory
+        is gone or cannot be read
+    """
+    try:
+        dir_mod_time = os.stat(dir_path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+
+    if listing_ttl:
+        cached = scanned_dirs.get(dir_path)
+        if cached is not None and cached[0] == dir_mod_time and time.monotonic() - cached[1] < listing_ttl:
+            return ({Path(dir_path, name): None for name in cached[2]},
+                    [os.path.join(dir_path, name) for name in cached[3]])
+
+    listed_at = time.monotonic()
+    listed_at_ns = time.time_ns()
     images = {}
+    subdirs = []
+    try:
+        # sorted, so that the order of scan results does not depend on the file system or on scheduling
+        with os.scandir(dir_path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
 
-    for search_dir in search_dirs:
-        for f in Path(search_dir).rglob('*'):
-            if not set(f.parents).isdisjoint(ignore_dirs):
-                continue
-            if f.suffix in extensions:
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        elif os.path.splitext(entry.name)[1] in extensions:
+            try:
+                images[Path(entry.path)] = _image_stat(entry.stat())
+            except FileNotFoundError as err:
+                if entry.is_symlink():
+                    print(Fore.CYAN, f'File {entry.path} is a symlink')
+                else:
+                    print(Fore.CYAN, f'Error while accessing file {entry.path}')
+                    print(err)
+
+    if listing_ttl:
+        if listed_at_ns - dir_mod_time < RACY_LISTING_WINDOW_NS:
+            # racily clean, like git index entries: the directory may change later without changing its mtime.
+            # Also covers mtimes in the future, e.g. set by a server whose clock is ahead
+            scanned_dirs.pop(dir_path, None)
+        else:
+            # names only, the stats are kept by tracked_images
+            scanned_dirs[dir_path] = (dir_mod_time, listed_at,
+                                      tuple(image.name for image in images),
+                                      tuple(os.path.basename(subdir) for subdir in subdirs))
+    return images, subdirs
+
+
+async def iter_image_batches(search_dirs, ignore_matcher, extensions, listing_ttl=0, workers=1, batch_size=1000):
+    """
+    Walks the tree breadth first and yields lists of (path, ImageStat) of at most batch_size images.
+    Ignored directories are never listed. Directories are listed on a pool of `workers` threads with a bounded
+    number of listings in flight, and results are yielded in listing order, so the output is the same
+    for any number of workers. The walk only advances while the consumer asks for more batches.
+    With listing_ttl, a directory whose mtime did not change since the previous pass is not listed again, and its
+    images are yielded with ImageStat None. A directory mtime changes when entries are created, removed or renamed
+    in it, but not when a file is rewritten in place, so every directory is listed and its files stat'ed again
+    once its listing is listing_ttl seconds old.
+    """
+    loop = asyncio.get_running_loop()
+    visited_dirs = set()
+    batch = []
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        level = sorted(str(search_dir) for search_dir in search_dirs)
+        while level:
+            next_level = []
+            pending_dirs = iter(level)
+            in_flight = deque()
+            while True:
+                for dir_path in pending_dirs:
+                    if dir_path in visited_dirs or ignore_matcher.is_ignored(dir_path):
+                        continue
+                    visited_dirs.add(dir_path)
+                    in_flight.append(loop.run_in_executor(executor, _scan_dir, dir_path, extensions, listing_ttl))
+                    if len(in_flight) >= 2 * workers:
+                        break
+                if not in_flight:
+                    break
+
+                listing = await in_flight.popleft()
+                if listing is not None:
+                    batch.extend(listing[0].items())
+                    next_level.extend(listing[1])
+                while len(batch) >= batch_size:
+                    yield batch[:batch_size]
+                    batch = batch[batch_size:]
+            level = next_level
+    finally:
+        executor.shutdown(wait=False)
+
+    if batch:
+        yield batch
+
+    if listing_ttl:
+        # forget directories that were removed or became ignored
+        for dir_path in scanned_dirs.keys() - visited_dirs:
+            if _is_within(dir_path, search_dirs):
+                scanned_dirs.pop(dir_path)
+
+
+def _is_within(path, dirs):
+    path = str(path)
+    return any(path == str(dir_) or path.startswith(os.path.join(str(dir_), '')) for dir_ in dirs)
+
+
+def _scan(search_dirs):
+    return iter_image_batches(search_dirs, CrawlerSettings.IGNORE_MATCHER, CrawlerSettings.EXTENSIONS,
+                              listing_ttl=CrawlerSettings.FULL_RESCAN_INTERVAL
+                              if CrawlerSettings.SCAN_MODE == 'incremental' else 0,
+                              workers=CrawlerSettings.SCAN_WORKERS,
+                              batch_size=CrawlerSettings.BATCH_SIZE)
+
+
+def _set_tracked(image_path, image_stat, detection_time):
+    tracked = tracked_images.get(image_path)
+    if tracked is not None and tracked['stat'] == image_stat:
+        tracked['detection_time'] = detection_time
+        return
+    if tracked is not None:
+        _forget_inode(image_path, tracked['stat'])
+    tracked_images[image_path] = {'detection_time': detection_time,
+                                  'stat': image_stat}
+    tracked_inodes[(image_stat.device, image_stat.inode)] = image_path
+    snapshot_state['dirty'] = True
+
+
+def _forget_inode(image_path, image_stat):
+    inode_key = (image_stat.device, image_stat.inode)
+    if tracked_inodes.get(inode_key) == image_path:
+        tracked_inodes.pop(inode_key)
+
+
+def _find_moved_from(image_stat):
+    """
+    :return: tracked path that holds the same file (device, inode, size and mtime) and does not exist anymore
+    """
+    old_path = tracked_inodes.get((image_stat.device, image_stat.inode))
+    if old_path is None:
+        return None
+    old_stat = tracked_images[old_path]['stat']
+    if old_stat.mod_time != image_stat.mod_time or old_stat.size != image_stat.size:
+        return None
+    try:
+        current_stat = os.lstat(old_path)
+    except FileNotFoundError:
+        return old_path
+    # old path exists, either a hard link or a different file was put in its place
+    if (current_stat.st_dev, current_stat.st_ino) == (image_stat.device, image_stat.inode):
+        return None
+    return old_path
+
+
+async def _track_image(image_path, image_stat, detection_time, changes):
+    tracked = tracked_images.get(image_path)
+    if tracked is None:
+        old_path = _find_moved_from(image_stat)
+        if old_path is not None:
+            old_stat = tracked_images.pop(old_path)['stat']
+            _forget_inode(old_path, old_stat)
+            _set_tracked(image_path, image_stat, detection_time)
+            await changes.put(Change(ChangeKind.MOVED, image_path, image_stat, old_path, time.monotonic()),
+                              {old_path: old_stat})
+            return
+        await changes.put(Change(ChangeKind.ADDED, image_path, image_stat, None, time.monotonic()))
+    elif tracked['stat'].mod_time != image_stat.mod_time or tracked['stat'].size != image_stat.size:
+        await changes.put(Change(ChangeKind.CHANGED, image_path, image_stat, None, time.monotonic()),
+                          {image_path: tracked['stat']})
+
+    _set_tracked(image_path, image_stat, detection_time)
+
+
+async def _untrack_image(image_path, changes):
+    tracked = tracked_images.pop(image_path, None)
+    if tracked is not None:
+        _forget_inode(image_path, tracked['stat'])
+        snapshot_state['dirty'] = True
+        await changes.put(Change(ChangeKind.REMOVED, image_path, None, None, time.monotonic()),
+                          {image_path: tracked['stat']})
+
+
+def load_tracked_images(snapshot_path):
+    """
+    Restores tracked images saved by a previous run, so that only real differences are emitted after a restart
+    """
+    if snapshot_path is None or not snapshot_path.is_file():
+        return
+    try:
+        for path, mod_time, size, inode, device in load_snapshot(snapshot_path):
+            _set_tracked(Path(path), ImageStat(mod_time, size, inode, device), None)
+    except (ValueError, EOFError, OSError) as err:
+        print(Fore.YELLOW, f'Ignoring unreadable crawl snapshot {snapshot_path}: {err}')
+        tracked_images.clear()
+        tracked_inodes.clear()
+        return
+    print(Fore.GREEN, f'Restored {len(tracked_images)} tracked images from {snapshot_path}')
+
+
+async def save_tracked_images(snapshot_path, changes, force=False):
+    """
+    Writes tracked images to the snapshot if they changed and the snapshot interval has passed. Paths with changes
+    that are not committed yet are saved as the database has them, so a restart detects those changes again
+    """
+    if snapshot_path is None or not snapshot_state['dirty']:
+        return
+    if not force and time.monotonic() - snapshot_state['saved_at'] < CrawlerSettings.SNAPSHOT_INTERVAL:
+        return
+
+    # copy is taken on the event loop, serialization happens off it
+    uncommitted = changes.uncommitted()
+    records = [(str(path), *tracked['stat']) for path, tracked in tracked_images.items() if path not in uncommitted]
+    records.extend((str(path), *image_stat) for path, image_stat in uncommitted.items() if image_stat is not None)
+    # saved again once the writers commit the rest
+    snapshot_state['dirty'] = len(uncommitted) > 0
+    snapshot_state['saved_at'] = time.monotonic()
+    await asyncio.get_running_loop().run_in_executor(None, save_snapshot, snapshot_path, records)
+
+
+async def _sync_tracked_images(image_batches, scope_dirs, changes):
+    """
+    Emits the difference between tracked images and a scan of scope_dirs. Queues are bounded, so the scan
+    is paused while the consumers catch up
+    :param image_batches: async iterable of lists of (path, ImageStat or None), see iter_image_batches
+    :param scope_dirs: directories the scan covered, tracked images outside of them are left as they are
+    """
+    crawling_start_time = datetime.datetime.now()
+    async for batch in image_batches:
+        for image_path, image_stat in batch:
+            if image_stat is None:
+                # directory listing was reused, the file is assumed unchanged
+                tracked = tracked_images.get(image_path)
+                if tracked is not None:
+                    tracked['detection_time'] = crawling_start_time
+                    continue
                 try:
-                    images[f] = f.stat().st_mtime_ns
-                except FileNotFoundError as err:
-                    if f.is_symlink():
-                        print(Fore.CYAN, f'File {f} is a symlink')
-                    else:
-                        print(Fore.CYAN, f'Error while accessing file {f}')
-                        print(err)
-    return images
+                    image_stat = _image_stat(image_path.stat())
+                except FileNotFoundError:
+                    continue
+            await _track_image(image_path, image_stat, crawling_start_time, changes)
+
+    removed = [tracked_image for tracked_image, tracked in tracked_images.items()
+               if tracked['detection_time'] != crawling_start_time and _is_within(tracked_image, scope_dirs)]
+    for tracked_image in removed:
+        await _untrack_image(tracked_image, changes)
+
+
+async def _no_images():
+    return
+    yield
+
+
+def _add_watches(watcher, dirs, polled_dirs):
+    """
+    Registers inotify watches for dirs and their subdirectories. When the watch limit is exhausted
+    the subtree is added to polled_dirs and left to the polling scan
+    """
+    pending_dirs = [str(dir_) for dir_ in dirs]
+    while pending_dirs:
+        dir_path = pending_dirs.pop()
+        if CrawlerSettings.IGNORE_MATCHER.is_ignored(dir_path) or _is_within(dir_path, polled_dirs):
+            continue
+        try:
+            if not watcher.add_watch(dir_path):
+                continue
+        except WatchLimitReached:
+            print(Fore.YELLOW, f'inotify watch limit reached, polling {dir_path} instead')
+            polled_dirs.add(dir_path)
+            continue
+        try:
+            with os.scandir(dir_path) as entries:
+                pending_dirs.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
 
 
-async def get_fs_changes(added_images, removed_images, changed_images, interval=5):
+async def _register_watches(watcher, dirs, polled_dirs):
+    # the walk lists every directory of the tree, so it runs off the event loop and the writers keep going.
+    # Events are only read by the caller, which waits for the walk, so the watcher is not used concurrently
+    await asyncio.get_running_loop().run_in_executor(None, _add_watches, watcher, dirs, polled_dirs)
+
+
+async def _apply_inotify_event(watcher, event, polled_dirs, moved_from, changes):
+    """
+    :param moved_from: (path, is_dir) renamed away, collected until the end of the event batch. If their destination
+        shows up inside the tracked tree in the same batch they are reported as moved, otherwise as removed
+    """
+    if event.mask & IN_Q_OVERFLOW:
+        # events were lost, fall back to a full sweep
+        print(Fore.YELLOW, 'inotify queue overflow, rescanning')
+        await _register_watches(watcher, CrawlerSettings.TRACKED_DIRS, polled_dirs)
+        await _sync_tracked_images(_scan(CrawlerSettings.TRACKED_DIRS), CrawlerSettings.TRACKED_DIRS, changes)
+        return
+
+    if event.mask & IN_ISDIR or event.mask & IN_DELETE_SELF:
+        if event.mask & (IN_CREATE | IN_MOVED_TO):
+            await _register_watches(watcher, [event.path], polled_dirs)
+            await _sync_tracked_images(_scan([event.path]), [event.path], changes)
+        elif event.mask & IN_MOVED_FROM:
+            watcher.remove_watches_under(event.path)
+            moved_from.append((event.path, True))
+        elif event.mask & (IN_DELETE | IN_DELETE_SELF):
+            watcher.remove_watches_under(event.path)
+            await _sync_tracked_images(_no_images(), [event.path], changes)
+        return
+
+    image_path = Path(event.path)
+    if image_path.suffix not in CrawlerSettings.EXTENSIONS:
+        return
+    if event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        try:
+            image_stat = _image_stat(image_path.stat())
+        except FileNotFoundError:
+            await _untrack_image(image_path, changes)
+            return
+        await _track_image(image_path, image_stat, datetime.datetime.now(), changes)
+    elif event.mask & IN_MOVED_FROM:
+        moved_from.append((event.path, False))
+    elif event.mask & IN_DELETE:
+        await _untrack_image(image_path, changes)
+
+
+async def _watch_fs_changes(watcher, changes, interval):
+    # watches go first so that nothing created during the initial sweep is missed
+    polled_dirs = set()
+    await _register_watches(watcher, CrawlerSettings.TRACKED_DIRS, polled_dirs)
+    await _sync_tracked_images(_scan(CrawlerSettings.TRACKED_DIRS), CrawlerSettings.TRACKED_DIRS, changes)
+    last_polled = time.monotonic()
+
+    while True:
+        if polled_dirs:
+            # time left until the next poll, events in the watched part of the tree do not postpone it
+            timeout = max(0.0, interval - (time.monotonic() - last_polled))
+        elif snapshot_state['dirty'] and CrawlerSettings.SNAPSHOT_PATH is not None:
+            timeout = CrawlerSettings.SNAPSHOT_INTERVAL
+        else:
+            timeout = None
+        events = await watcher.get_events(timeout=timeout)
+        if events is not None:
+            moved_from = []
+            for event in events:
+                await _apply_inotify_event(watcher, event, polled_dirs, moved_from, changes)
+            # whatever was not picked up as a move source has left the tracked tree
+            for path, is_dir in moved_from:
+                if is_dir:
+                    await _sync_tracked_images(_no_images(), [path], changes)
+                else:
+                    await _untrack_image(Path(path), changes)
+        if polled_dirs and time.monotonic() - last_polled >= interval:
+            await _sync_tracked_images(_scan(polled_dirs), polled_dirs, changes)
+            last_polled = time.monotonic()
+        await save_tracked_images(CrawlerSettings.SNAPSHOT_PATH, changes)
+
+
+async def get_fs_changes(changes, interval=5):
+    """
+    Detects changes in the tracked directories
+    :param changes: ChangeQueues that get a Change for every added, changed, removed or moved image
+    """
     print(CrawlerSettings.EXTENSIONS,
           CrawlerSettings.TRACKED_DIRS,
           CrawlerSettings.IGNORED_DIRS)
-    while True:
-        crawling_start_time = datetime.datetime.now()
-        for image_path, mod_time in retrieve_images(CrawlerSettings.TRACKED_DIRS,
-                                                    CrawlerSettings.IGNORED_DIRS,
-                                                    CrawlerSettings.EXTENSIONS).items():
-            if image_path not in tracked_images:
-                await added_images.put(item=image_path)
-            elif tracked_images[image_path]['mod_time'] != mod_time:
-                await changed_images.put(item=image_path)
-
-            tracked_images[image_path] = {'detection_time': crawling_start_time,
-                                          'mod_time': mod_time}
-
-        tracked_image_paths = tuple(tracked_images.keys())
-        for tracked_image in tracked_image_paths:
-            if tracked_images[tracked_image]['detection_time'] != crawling_start_time:
-                await removed_images.put(item=tracked_image)
-                tracked_images.pop(tracked_image)
+    load_tracked_images(CrawlerSettings.SNAPSHOT_PATH)
+    try:
+        await _get_fs_changes(changes, interval)
+    finally:
+        await save_tracked_images(CrawlerSettings.SNAPSHOT_PATH, changes, force=True)
 
+
+async def _get_fs_changes(changes, interval):
+    if CrawlerSettings.WATCH_BACKEND == 'inotify':
+        try:
+            watcher = InotifyWatcher()
+        except InotifyUnavailable as err:
+            print(Fore.YELLOW, f'inotify is not available ({err}), falling back to polling')
+        else:
+            try:
+                await _watch_fs_changes(watcher, changes, interval)
+            finally:
+                watcher.close()
+
+    while True:
+        await _sync_tracked_images(_scan(CrawlerSettings.TRACKED_DIRS), CrawlerSettings.TRACKED_DIRS, changes)
+        await save_tracked_images(CrawlerSettings.SNAPSHOT_PATH, changes)
         print(Fore.RED, 'SLEEP')
         await asyncio.sleep(interval)
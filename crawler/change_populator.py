@@ -1,42 +1,167 @@
 import asyncio
+import time
+from collections import Counter
 
+import aiomysql
 from colorama import Fore
+from change_queues import ChangeKind
+from crawler_settings import CrawlerSettings
 from illusion.settings import LOCAL_IMAGE_ROOT
 
+WRITE_RETRIES = 5
+LATENCY_REPORT_INTERVAL = 60
 
-async def apply_fs_changes(conn, added_images, removed_images, changed_images):
-    cur = await conn.cursor()
+# file_path is unique, so re-adding a file that was marked as deleted revives its row
+UPSERT_IMAGES = ("INSERT INTO base_image (file_path, last_modified_time, is_deleted) "
+                 "VALUES (%s, %s, 0) "
+                 "ON DUPLICATE KEY UPDATE last_modified_time = VALUES(last_modified_time), is_deleted = 0")
+MARK_REMOVED = ("UPDATE base_image "
+                "SET is_deleted = 1 "
+                "WHERE file_path = %s")
+# the row keeps its id, so everything attached to it survives the move
+MOVE_IMAGES = ("UPDATE base_image "
+               "SET file_path = %s "
+               "WHERE file_path = %s")
+# a row left at the destination (e.g. a file deleted earlier under that name) would violate the unique file_path,
+# it is removed only if the source row exists, so replaying a move that was already written keeps the moved row
+FREE_MOVE_DESTINATION = ("DELETE destination FROM base_image AS destination "
+                         "JOIN base_image AS source ON source.file_path = %s "
+                         "WHERE destination.file_path = %s")
+
+CHANGE_DESCRIPTIONS = {
+    ChangeKind.ADDED: 'inserted',
+    ChangeKind.CHANGED: 'updated',
+    ChangeKind.REMOVED: 'marked as removed',
+    ChangeKind.MOVED: 'moved',
+}
+
+
+class LatencyStats:
+    """
+    Time from detection of a change to the commit that persisted it. Shared by all writers,
+    reported every LATENCY_REPORT_INTERVAL seconds
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.reported_at = time.monotonic()
+
+    def record(self, detection_times):
+        committed_at = time.monotonic()
+        self.latencies.extend(committed_at - detection_time for detection_time in detection_times)
+        if committed_at - self.reported_at >= LATENCY_REPORT_INTERVAL:
+            self.report()
+
+    def report(self):
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            print(Fore.CYAN, f'{len(latencies)} changes committed, detection to commit latency: '
+                             f'mean {sum(latencies) / len(latencies) * 1000:.1f}ms, '
+                             f'p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, '
+                             f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, '
+                             f'max {latencies[-1] * 1000:.1f}ms')
+        self.latencies = []
+        self.reported_at = time.monotonic()
+
+
+commit_latency = LatencyStats()
+
+
+def _relative_path(img):
+    return str(img.relative_to(LOCAL_IMAGE_ROOT))
+
+
+async def _drain(queue, items, max_items, max_delay):
+    """
+    Adds up to max_items from the queue to items, waiting at most max_delay seconds for more items to arrive
+    :return: items
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_delay
+    while len(items) < max_items:
+        try:
+            items.append(queue.get_nowait())
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+
+async def _execute_batch(pool, statements):
+    """
+    Runs executemany for every (query, rows) in order on a pooled connection and commits them as one transaction.
+    A dropped connection is closed, so the pool does not hand it out again, and the batch is retried on a fresh one
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            async with pool.acquire() as conn:
+                try:
+                    async with conn.cursor() as cur:
+                        for query, rows in statements:
+                            await cur.executemany(query, rows)
+                    await conn.commit()
+                except (aiomysql.OperationalError, aiomysql.InterfaceError):
+                    conn.close()
+                    raise
+            return
+        except (aiomysql.OperationalError, aiomysql.InterfaceError) as err:
+            if attempt == WRITE_RETRIES - 1:
+                raise
+            print(Fore.YELLOW, f'Database connection lost ({err}), retrying')
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+
+def _statements(change):
+    """
+    :return: list of (query, row) that write the change
+    """
+    if change.kind in (ChangeKind.ADDED, ChangeKind.CHANGED):
+        # mtime comes from the detector, files are not accessed again
+        return [(UPSERT_IMAGES, (_relative_path(change.path), change.stat.mod_time))]
+    if change.kind == ChangeKind.REMOVED:
+        return [(MARK_REMOVED, (_relative_path(change.path),))]
+    old_path, new_path = _relative_path(change.old_path), _relative_path(change.path)
+    return [(FREE_MOVE_DESTINATION, (old_path, new_path)),
+            (MOVE_IMAGES, (new_path, old_path))]
+
+
+async def _write_changes(pool, batch):
+    # consecutive changes with the same query share an executemany, the order of changes is kept
+    statements = []
+    for change in batch:
+        for query, row in _statements(change):
+            if statements and statements[-1][0] == query:
+                statements[-1][1].append(row)
+            else:
+                statements.append((query, [row]))
+    await _execute_batch(pool, statements)
+
+    counts = Counter(change.kind for change in batch)
+    print(', '.join(f'{counts[kind]} images are {description}'
+                    for kind, description in CHANGE_DESCRIPTIONS.items() if counts[kind] > 0))
+
+
+async def apply_fs_changes(pool, queue, changes):
+    """
+    Writes changes from one of the queues of changes (ChangeQueues) to the database. One of these runs for every
+    queue on a shared pool. A writer sleeps until its queue has an item, then collects a batch until it has
+    WRITE_BATCH_SIZE items or WRITE_BATCH_DELAY has passed, and commits it
+    """
     # await cur.execute('CREATE TABLE IF NOT EXISTS base_image (id INT PRIMARY KEY AUTO_INCREMENT, '
     #                   'path VARCHAR(70), '
     #                   'last_mod_time BIGINT, '
     #                   'is_deleted TINYINT DEFAULT 1);')
     # await conn.commit()
     while True:
-        if not added_images.empty():
-            print(Fore.GREEN, 'added_images')
-        while not added_images.empty():
-            img = await added_images.get()
-            await cur.execute(f"INSERT INTO base_image (file_path, last_modified_time, is_deleted) "
-                              f"VALUES('{str(img.relative_to(LOCAL_IMAGE_ROOT))}',{img.stat().st_mtime_ns}, 0)")
-            await conn.commit()
-            print(f'Image {img} is inserted')
-
-        if not removed_images.empty():
-            print(Fore.GREEN, 'removed_images')
-        while not removed_images.empty():
-            img = await removed_images.get()
-            await cur.execute(f"UPDATE base_image "
-                              f"SET is_deleted = 1 "
-                              f"WHERE file_path = '{str(img)}';")
-            await conn.commit()
-            print(f'Image {img} is marked as removed')
-
-        if not changed_images.empty():
-            print(Fore.GREEN, 'changed_images')
-        while not changed_images.empty():
-            print(await changed_images.get())
-
-        print('END OF CYCLe')
-        await asyncio.sleep(5)
-
-    await cur.close()
+        batch = await _drain(queue, [await queue.get()],
+                             CrawlerSettings.WRITE_BATCH_SIZE, CrawlerSettings.WRITE_BATCH_DELAY)
+        await _write_changes(pool, batch)
+        await changes.task_done(batch)
+        commit_latency.record(change.detection_time for change in batch)
@@ -0,0 +1,72 @@
+import asyncio
+from collections import namedtuple
+from enum import Enum
+
+
+class ChangeKind(Enum):
+    ADDED = 1
+    CHANGED = 2
+    REMOVED = 3
+    MOVED = 4  # path is the new path, old_path is where the file was before
+
+
+# stat is None for removed images, old_path is None for anything but moves. Detection time is time.monotonic()
+Change = namedtuple('Change', ['kind', 'path', 'stat', 'old_path', 'detection_time'])
+
+
+def _change_paths(change):
+    return (change.path,) if change.old_path is None else (change.old_path, change.path)
+
+
+class ChangeQueues:
+    """
+    Detected changes split over one bounded queue per database writer. A path is assigned to a queue when a change
+    of it is put, and keeps that queue until all of its changes are committed, so changes of one path are written
+    by a single writer in detection order. A move touches two paths and goes to the queue of whichever of them has
+    uncommitted changes, if both have them in different queues it waits until one is committed.
+    For every path with uncommitted changes it also keeps the ImageStat the database reflects, see uncommitted
+    """
+
+    def __init__(self, writers, maxsize):
+        self.queues = [asyncio.Queue(maxsize=maxsize) for _ in range(writers)]
+        self._pending = {}  # path, [queue index, number of uncommitted changes, committed ImageStat or None]
+        self._committed = asyncio.Condition()
+
+    def _pending_queues(self, paths):
+        return {self._pending[path][0] for path in paths if path in self._pending}
+
+    async def put(self, change, committed_stats=None):
+        """
+        :param committed_stats: dict of path to the ImageStat tracked before this change, for paths of the change
+            that were tracked. Only the one given with the first uncommitted change of a path is kept
+        """
+        committed_stats = committed_stats or {}
+        paths = _change_paths(change)
+        async with self._committed:
+            await self._committed.wait_for(lambda: len(self._pending_queues(paths)) <= 1)
+            pending_queues = self._pending_queues(paths)
+            index = pending_queues.pop() if pending_queues else hash(paths[-1]) % len(self.queues)
+            for path in paths:
+                self._pending.setdefault(path, [index, 0, committed_stats.get(path)])[1] += 1
+        # blocks while the writer is behind, which pauses the scan
+        await self.queues[index].put(change)
+
+    def uncommitted(self):
+        """
+        :return: dict of path with uncommitted changes to the ImageStat the database reflects, None if the database
+            has no live image at the path
+        """
+        return {path: pending[2] for path, pending in self._pending.items()}
+
+    async def task_done(self, changes):
+        """
+        Called by a writer once changes taken from its queue are committed
+        """
+        async with self._committed:
+            for change in changes:
+                for path in _change_paths(change):
+                    pending = self._pending[path]
+                    pending[1] -= 1
+                    if pending[1] == 0:
+                        del self._pending[path]
+            self._committed.notify_all()
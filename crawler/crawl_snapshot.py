@@ -0,0 +1,52 @@
+import gzip
+import os
+import struct
+
+SNAPSHOT_MAGIC = b'ILLSNAP'
+SNAPSHOT_VERSION = 2
+
+_RECORD_HEADERS = {
+    1: struct.Struct('<qqQI'),  # mod_time, size, inode, path length
+    2: struct.Struct('<qqQQI'),  # mod_time, size, inode, device, path length
+}
+
+
+def save_snapshot(snapshot_path, records):
+    """
+    Writes tracked images to a gzip compressed binary file. The file is replaced atomically,
+    so a crash while saving leaves the previous snapshot intact
+    :param records: iterable of (path, mod_time, size, inode, device)
+    """
+    record_header = _RECORD_HEADERS[SNAPSHOT_VERSION]
+    tmp_path = f'{snapshot_path}.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=1) as snapshot:
+        snapshot.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]))
+        for path, mod_time, size, inode, device in records:
+            encoded_path = os.fsencode(path)
+            snapshot.write(record_header.pack(mod_time, size, inode, device, len(encoded_path)))
+            snapshot.write(encoded_path)
+    os.replace(tmp_path, snapshot_path)
+
+
+def load_snapshot(snapshot_path):
+    """
+    Reads records written by save_snapshot. Version 1 snapshots have no device, it is reported as 0
+    :return: generator of (path, mod_time, size, inode, device)
+    """
+    with gzip.open(snapshot_path, 'rb') as snapshot:
+        header = snapshot.read(len(SNAPSHOT_MAGIC) + 1)
+        if header[:-1] != SNAPSHOT_MAGIC or header[-1] not in _RECORD_HEADERS:
+            raise ValueError(f'Unsupported snapshot format: {snapshot_path}')
+        version = header[-1]
+        record_header = _RECORD_HEADERS[version]
+
+        while True:
+            record = snapshot.read(record_header.size)
+            if not record:
+                return
+            if version == 1:
+                mod_time, size, inode, path_len = record_header.unpack(record)
+                device = 0
+            else:
+                mod_time, size, inode, device, path_len = record_header.unpack(record)
+            yield os.fsdecode(snapshot.read(path_len)), mod_time, size, inode, device
@@ -5,22 +5,27 @@ import aiomysql
 
 from change_detector import get_fs_changes
 from change_populator import apply_fs_changes
+from change_queues import ChangeQueues
 from crawler_settings import CrawlerSettings
 
-added_images = asyncio.Queue()
-removed_images = asyncio.Queue()
-changed_images = asyncio.Queue()
-
 
 async def get_running_tasks():
-    conn = await aiomysql.connect(host='127.0.0.1', port=3306,
-                                  user='root', password='newpassword',
-                                  db='illusion')
-    tasks = await asyncio.gather(
-        get_fs_changes(added_images, removed_images, changed_images),
-        apply_fs_changes(conn, added_images, removed_images, changed_images)
-    )
-    conn.close()
+    # bounded, so that the scan slows down when the database writes fall behind
+    changes = ChangeQueues(CrawlerSettings.DB_WRITERS, CrawlerSettings.QUEUE_SIZE)
+    # idle connections are recycled before MySQL wait_timeout drops them
+    pool = await aiomysql.create_pool(host='127.0.0.1', port=3306,
+                                      user='root', password='newpassword',
+                                      db='illusion',
+                                      minsize=1, maxsize=CrawlerSettings.DB_WRITERS,
+                                      pool_recycle=3600)
+    try:
+        tasks = await asyncio.gather(
+            get_fs_changes(changes),
+            *(apply_fs_changes(pool, queue, changes) for queue in changes.queues)
+        )
+    finally:
+        pool.close()
+        await pool.wait_closed()
     return tasks
 
 
@@ -1,16 +1,32 @@
 import configparser
-from pathlib import PosixPath
+from pathlib import Path, PosixPath
+
+from ignore_matcher import IgnoreMatcher
+
+CONFIG_PATH = Path('../config.ini')
 
 
 class CrawlerSettings:
     TRACKED_DIRS = None
     IGNORED_DIRS = None
+    IGNORE_MATCHER = None
     EXTENSIONS = None
+    SCAN_MODE = None
+    FULL_RESCAN_INTERVAL = None
+    SCAN_WORKERS = None
+    BATCH_SIZE = None
+    QUEUE_SIZE = None
+    WRITE_BATCH_SIZE = None
+    WRITE_BATCH_DELAY = None
+    DB_WRITERS = None
+    WATCH_BACKEND = None
+    SNAPSHOT_PATH = None
+    SNAPSHOT_INTERVAL = None
 
     @classmethod
     def load(cls):
         config = configparser.ConfigParser()
-        config.read('../config.ini')
+        config.read(CONFIG_PATH)
 
         search_dirs_str = config['DIRECTORIES']['search_dirs'].strip()
         cls.TRACKED_DIRS = set(map(str.strip, search_dirs_str.split(','))) if search_dirs_str != '' else {}
@@ -18,8 +34,28 @@ class CrawlerSettings:
         ignore_dirs_str = config['DIRECTORIES']['ignore_dirs'].strip()
         cls.IGNORED_DIRS = set(
             map(lambda p: PosixPath(p.strip()), ignore_dirs_str.split(','))) if ignore_dirs_str != '' else {}
+        cls.IGNORE_MATCHER = IgnoreMatcher(cls.IGNORED_DIRS)
 
         extensions_str = config['EXTENSIONS']['image_extensions'].strip()
         cls.EXTENSIONS = {f'.{ext}' for ext in extensions_str.split(',')} if extensions_str != '' else {'.png',
                                                                                                         '.jpeg',
                                                                                                         '.jpg'}
+
+        cls.SCAN_MODE = config.get('CRAWLER', 'scan_mode', fallback='full').strip()
+        if cls.SCAN_MODE not in ('full', 'incremental'):
+            raise ValueError(f'Unknown scan mode: {cls.SCAN_MODE}')
+        cls.FULL_RESCAN_INTERVAL = max(1.0, config.getfloat('CRAWLER', 'full_rescan_interval', fallback=3600.0))
+        cls.SCAN_WORKERS = max(1, config.getint('CRAWLER', 'scan_workers', fallback=1))
+        cls.BATCH_SIZE = max(1, config.getint('CRAWLER', 'batch_size', fallback=1000))
+        cls.QUEUE_SIZE = max(1, config.getint('CRAWLER', 'queue_size', fallback=10000))
+        cls.WRITE_BATCH_SIZE = max(1, config.getint('CRAWLER', 'write_batch_size', fallback=500))
+        cls.WRITE_BATCH_DELAY = config.getfloat('CRAWLER', 'write_batch_delay_ms', fallback=50) / 1000
+        cls.DB_WRITERS = max(1, config.getint('CRAWLER', 'db_writers', fallback=1))
+
+        cls.WATCH_BACKEND = config.get('CRAWLER', 'watch_backend', fallback='poll').strip()
+        if cls.WATCH_BACKEND not in ('poll', 'inotify'):
+            raise ValueError(f'Unknown watch backend: {cls.WATCH_BACKEND}')
+
+        snapshot_path_str = config.get('CRAWLER', 'snapshot_path', fallback='').strip()
+        cls.SNAPSHOT_PATH = CONFIG_PATH.parent.joinpath(snapshot_path_str) if snapshot_path_str != '' else None
+        cls.SNAPSHOT_INTERVAL = config.getfloat('CRAWLER', 'snapshot_interval', fallback=60.0)
@@ -0,0 +1,138 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from collections import namedtuple
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+_READ_SIZE = 64 * 1024
+
+InotifyEvent = namedtuple('InotifyEvent', ['path', 'mask', 'cookie'])
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class WatchLimitReached(Exception):
+    pass
+
+
+def _load_libc():
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        raise InotifyUnavailable('libc is not found')
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise InotifyUnavailable('inotify is not supported on this platform')
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Thin asyncio wrapper around Linux inotify. Watches are not recursive, so every directory of the tree
+    is registered separately with add_watch
+    """
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+        self._wd_to_dir = {}
+        self._dir_to_wd = {}
+        self._readable = asyncio.Event()
+        self._loop = None
+
+    def add_watch(self, dir_path):
+        """
+        :return: False if the directory does not exist anymore
+        :raises WatchLimitReached: when fs.inotify.max_user_watches is exhausted
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitReached(dir_path)
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return False
+            raise OSError(err, os.strerror(err), dir_path)
+        self._wd_to_dir[wd] = dir_path
+        self._dir_to_wd[dir_path] = wd
+        return True
+
+    def remove_watches_under(self, dir_path):
+        prefix = dir_path + os.sep
+        for watched_dir in [d for d in self._dir_to_wd if d == dir_path or d.startswith(prefix)]:
+            wd = self._dir_to_wd.pop(watched_dir)
+            self._wd_to_dir.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        events = []
+        while True:
+            try:
+                buffer = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+
+                if mask & IN_Q_OVERFLOW:
+                    events.append(InotifyEvent(None, mask, cookie))
+                    continue
+                dir_path = self._wd_to_dir.get(wd)
+                if mask & IN_IGNORED:
+                    # watch was removed by the kernel (directory deleted or unmounted)
+                    if dir_path is not None and self._dir_to_wd.get(dir_path) == wd:
+                        self._dir_to_wd.pop(dir_path)
+                    self._wd_to_dir.pop(wd, None)
+                    continue
+                if dir_path is None:
+                    continue
+                events.append(InotifyEvent(os.path.join(dir_path, name) if name else dir_path, mask, cookie))
+
+    async def get_events(self, timeout=None):
+        """
+        Waits until events are available or timeout (seconds) expires
+        :return: list of InotifyEvent, None on timeout
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self._fd, self._readable.set)
+        try:
+            await asyncio.wait_for(self._readable.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._readable.clear()
+        return self._read_events()
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop = None
+        os.close(self._fd)
@@ -0,0 +1,55 @@
+import fnmatch
+import re
+from pathlib import PurePath
+
+_TERMINAL = None  # trie key marking the end of an ignored path
+
+
+def _is_glob(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+class IgnoreMatcher:
+    """
+    Ignore rules compiled once. Plain paths are stored in a trie of path components, so a directory
+    is ignored if it or any of its ancestors was listed. Glob patterns without a separator (`*.photoslibrary`)
+    are matched against the directory name, patterns with a separator against the whole path
+    """
+
+    def __init__(self, patterns):
+        self._trie = {}
+        name_globs = []
+        path_globs = []
+
+        for pattern in patterns:
+            pattern = str(pattern).strip()
+            if pattern == '':
+                continue
+            if _is_glob(pattern):
+                pattern = pattern.rstrip('/')
+                (path_globs if '/' in pattern else name_globs).append(fnmatch.translate(pattern))
+            else:
+                node = self._trie
+                for part in PurePath(pattern).parts:
+                    node = node.setdefault(part, {})
+                node[_TERMINAL] = True
+
+        self._name_regex = re.compile('|'.join(name_globs)) if name_globs else None
+        self._path_regex = re.compile('|'.join(path_globs)) if path_globs else None
+
+    def is_ignored(self, dir_path):
+        dir_path = PurePath(dir_path)
+
+        node = self._trie
+        for part in dir_path.parts:
+            node = node.get(part)
+            if node is None:
+                break
+            if _TERMINAL in node:
+                return True
+
+        if self._name_regex is not None and self._name_regex.match(dir_path.name):
+            return True
+        if self._path_regex is not None and self._path_regex.match(str(dir_path)):
+            return True
+        return False
@@ -1,3 +1,148 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import os
+import struct
+import tempfile
+import unittest
+from pathlib import Path
 
-# Create your tests here.
+from crawler.change_queues import Change, ChangeKind, ChangeQueues
+from crawler.crawl_snapshot import SNAPSHOT_MAGIC, load_snapshot, save_snapshot
+from crawler.ignore_matcher import IgnoreMatcher
+
+
+def _queued(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def _paths_in_different_queues(changes):
+    """
+    :return: two paths that are assigned to different queues while neither has pending changes
+    """
+    first = Path('/photos/0.jpg')
+    for number in range(1, 100):
+        second = Path(f'/photos/{number}.jpg')
+        if hash(first) % len(changes.queues) != hash(second) % len(changes.queues):
+            return first, second
+    raise AssertionError('no paths hash to different queues')
+
+
+class ChangeQueuesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_changes_of_a_path_go_to_one_queue_in_order(self):
+        changes = ChangeQueues(writers=4, maxsize=10)
+        path = Path('/photos/a.jpg')
+        added = Change(ChangeKind.ADDED, path, (1, 10, 100, 1), None, 0.0)
+        removed = Change(ChangeKind.REMOVED, path, None, None, 1.0)
+
+        await changes.put(added)
+        await changes.put(removed, {path: (1, 10, 100, 1)})
+
+        queued = [_queued(queue) for queue in changes.queues]
+        self.assertIn([added, removed], queued)
+        self.assertEqual(sum(len(items) for items in queued), 2)
+
+    async def test_move_waits_until_one_of_its_paths_is_committed(self):
+        changes = ChangeQueues(writers=2, maxsize=10)
+        old_path, new_path = _paths_in_different_queues(changes)
+        added_old = Change(ChangeKind.ADDED, old_path, (1, 10, 100, 1), None, 0.0)
+        added_new = Change(ChangeKind.ADDED, new_path, (1, 20, 200, 1), None, 0.0)
+        moved = Change(ChangeKind.MOVED, new_path, (1, 10, 100, 1), old_path, 1.0)
+        await changes.put(added_old)
+        await changes.put(added_new)
+
+        put_move = asyncio.ensure_future(changes.put(moved))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertFalse(put_move.done())
+
+        await changes.task_done([added_old])
+        await asyncio.wait_for(put_move, 1)
+        queued = [_queued(queue) for queue in changes.queues]
+        self.assertIn([added_old], queued)
+        self.assertIn([added_new, moved], queued)
+
+    async def test_uncommitted_keeps_the_stat_before_the_first_pending_change(self):
+        changes = ChangeQueues(writers=1, maxsize=10)
+        path, added_path = Path('/photos/a.jpg'), Path('/photos/b.jpg')
+        committed_stat, first_stat, second_stat = (1, 10, 100, 1), (2, 11, 100, 1), (3, 12, 100, 1)
+        first = Change(ChangeKind.CHANGED, path, first_stat, None, 0.0)
+        second = Change(ChangeKind.CHANGED, path, second_stat, None, 1.0)
+        added = Change(ChangeKind.ADDED, added_path, first_stat, None, 1.0)
+
+        await changes.put(first, {path: committed_stat})
+        await changes.put(second, {path: first_stat})
+        await changes.put(added)
+        self.assertEqual(changes.uncommitted(), {path: committed_stat, added_path: None})
+
+        await changes.task_done([first])
+        self.assertEqual(changes.uncommitted(), {path: committed_stat, added_path: None})
+
+        await changes.task_done([second, added])
+        self.assertEqual(changes.uncommitted(), {})
+
+
+class IgnoreMatcherTest(unittest.TestCase):
+
+    def test_plain_path_ignores_the_directory_and_its_descendants(self):
+        matcher = IgnoreMatcher(['/photos/private/'])
+        self.assertTrue(matcher.is_ignored('/photos/private'))
+        self.assertTrue(matcher.is_ignored('/photos/private/2020/trip'))
+        self.assertFalse(matcher.is_ignored('/photos'))
+        self.assertFalse(matcher.is_ignored('/photos/private_backup'))
+
+    def test_name_glob_matches_at_any_depth(self):
+        matcher = IgnoreMatcher(['*.photoslibrary', '.Trash*'])
+        self.assertTrue(matcher.is_ignored('/photos/Photos Library.photoslibrary'))
+        self.assertTrue(matcher.is_ignored('/photos/2020/.Trashes'))
+        self.assertFalse(matcher.is_ignored('/photos/photoslibrary'))
+
+    def test_path_glob_matches_the_whole_path(self):
+        matcher = IgnoreMatcher(['/photos/*/cache'])
+        self.assertTrue(matcher.is_ignored('/photos/2020/cache'))
+        self.assertFalse(matcher.is_ignored('/backup/2020/cache'))
+
+    def test_empty_patterns_ignore_nothing(self):
+        matcher = IgnoreMatcher(['', '  '])
+        self.assertFalse(matcher.is_ignored('/'))
+        self.assertFalse(matcher.is_ignored('/photos'))
+
+
+class CrawlSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.snapshot_dir.name, 'crawl_snapshot.bin')
+
+    def tearDown(self):
+        self.snapshot_dir.cleanup()
+
+    def test_round_trip(self):
+        records = [
+            ('/photos/a.jpg', 1665500000123456789, 2048, 12, 64769),
+            ('/photos/фото/b.jpeg', -1, 0, 2 ** 63, 2 ** 32),
+        ]
+        save_snapshot(self.snapshot_path, records)
+        self.assertEqual(list(load_snapshot(self.snapshot_path)), records)
+        self.assertFalse(os.path.exists(f'{self.snapshot_path}.tmp'))
+
+    def test_empty_snapshot(self):
+        save_snapshot(self.snapshot_path, [])
+        self.assertEqual(list(load_snapshot(self.snapshot_path)), [])
+
+    def test_version_1_is_read_without_device(self):
+        encoded_path = os.fsencode('/photos/a.jpg')
+        with gzip.open(self.snapshot_path, 'wb') as snapshot:
+            snapshot.write(SNAPSHOT_MAGIC + bytes([1]))
+            snapshot.write(struct.pack('<qqQI', 100, 2048, 12, len(encoded_path)))
+            snapshot.write(encoded_path)
+        self.assertEqual(list(load_snapshot(self.snapshot_path)), [('/photos/a.jpg', 100, 2048, 12, 0)])
+
+    def test_unknown_format_is_rejected(self):
+        with gzip.open(self.snapshot_path, 'wb') as snapshot:
+            snapshot.write(b'NOTSNAP' + bytes([1]))
+        with self.assertRaises(ValueError):
+            list(load_snapshot(self.snapshot_path))
@@ -1,10 +1,51 @@
+import sqlite3
 from pathlib import Path
 
 import peewee as pw
+from playhouse.pool import PooledSqliteDatabase
 
+# default SQLITE_MAX_VARIABLE_NUMBER of SQLite builds before 3.32, bulk statements are chunked to stay below it
+SQLITE_MAX_VARIABLES = 999
 
-def get_database(database_path):
-    pw_database = pw.SqliteDatabase(database_path, pragmas={'foreign_keys': 1})
+STORAGE_PROFILES = {
+    # rollback journal, readers and writers block each other
+    'default': {
+        'foreign_keys': 1,
+    },
+    # write ahead log, readers work on the last committed state while metadata is written
+    'wal': {
+        'foreign_keys': 1,
+        'journal_mode': 'wal',
+        'synchronous': 'normal',  # durable at checkpoints, a power loss can only drop the latest commits
+        'cache_size': -64 * 1024,  # KiB
+        'mmap_size': 256 * 1024 * 1024,
+        'wal_autocheckpoint': 1000,  # pages
+        'journal_size_limit': 64 * 1024 * 1024,  # the log is truncated to this size after a checkpoint
+        'busy_timeout': 5000,  # ms
+    },
+}
+
+# pragmas of a storage profile that can be set on a read only connection
+READ_ONLY_PRAGMAS = {'foreign_keys', 'cache_size', 'mmap_size', 'busy_timeout'}
+
+
+def get_database(database_path, storage_profile='wal', read_only=False, max_connections=4):
+    """
+    Creates model classes bound to the database
+    :param storage_profile: key of STORAGE_PROFILES
+    :param read_only: bind models to a pool of read only connections, tables are not created.
+        Catalog reads run on these connections concurrently with writes on the read write one
+    :param max_connections: size of the read only pool
+    """
+    pragmas = STORAGE_PROFILES[storage_profile]
+    if read_only:
+        pw_database = PooledSqliteDatabase(
+            f'file:{Path(database_path).resolve()}?mode=ro', uri=True, check_same_thread=False,
+            max_connections=max_connections, stale_timeout=3600,
+            pragmas={key: value for key, value in pragmas.items() if key in READ_ONLY_PRAGMAS}
+        )
+    else:
+        pw_database = pw.SqliteDatabase(database_path, pragmas=pragmas)
 
     class IllusionDb(pw.Model):
         class Meta:
@@ -35,6 +76,77 @@ def get_database(database_path):
             except:
                 return None
 
+        @classmethod
+        def get_existing_with_file_stat(cls, paths):
+            """
+            Looks up many paths with one IN query per chunk
+            :param paths: resolved path strings
+            :return: dict path -> (image id, (size, mtime_ns, inode) or None if no signature was recorded)
+            """
+            existing = {}
+            for paths_chunk in pw.chunked(paths, SQLITE_MAX_VARIABLES):
+                query = (
+                    cls.select(cls.id, cls.path, ImageFileStat.size, ImageFileStat.mtime_ns, ImageFileStat.inode)
+                    .join(ImageFileStat, pw.JOIN.LEFT_OUTER, on=(ImageFileStat.image == cls.id))
+                    .where(cls.path.in_(paths_chunk))
+                    .tuples()
+                )
+                for id_, path, size, mtime_ns, inode in query:
+                    existing[path] = (id_, None if size is None else (size, mtime_ns, inode))
+            return existing
+
+        @classmethod
+        def create_images(cls, rows):
+            """
+            Inserts many images in one transaction
+            :param rows: list of (resolved path string, md5)
+            :return: dict path -> id of the new image
+            """
+            created = {}
+            with pw_database.atomic():
+                for rows_chunk in pw.chunked(rows, SQLITE_MAX_VARIABLES // 2):
+                    cls.insert_many(rows_chunk, fields=[cls.path, cls.md5]).execute()
+                for rows_chunk in pw.chunked(rows, SQLITE_MAX_VARIABLES):
+                    query = cls.select(cls.id, cls.path).where(cls.path.in_([path for path, _ in rows_chunk]))
+                    created.update((path, id_) for id_, path in query.tuples())
+            return created
+
+        @classmethod
+        def get_analyzed_with_md5(cls, md5s):
+            """
+            Finds images with faces and tags detected that have one of the hashes
+            :return: dict md5 -> id of the oldest such image
+            """
+            analyzed = {}
+            for md5s_chunk in pw.chunked(md5s, SQLITE_MAX_VARIABLES):
+                query = (
+                    cls.select(cls.md5, pw.fn.MIN(cls.id))
+                    .where(cls.md5.in_(md5s_chunk) & (cls.faces_detected == True) & (cls.tags_detected == True))
+                    .group_by(cls.md5)
+                    .tuples()
+                )
+                analyzed.update(query)
+            return analyzed
+
+        @classmethod
+        def get_not_analyzed_with_md5(cls, md5):
+            """
+            Finds images with the hash that miss faces, tags or the fingerprint
+            :return: list of (image id, True if only the fingerprint is missing)
+            """
+            query = (
+                cls.select(cls.id, cls.faces_detected, cls.tags_detected)
+                .join(ImageFingerprint, pw.JOIN.LEFT_OUTER, on=(ImageFingerprint.image == cls.id))
+                .where(
+                    (cls.md5 == md5) & (
+                        (cls.faces_detected == False) | (cls.tags_detected == False) |
+                        ImageFingerprint.image.is_null()
+                    )
+                )
+                .tuples()
+            )
+            return [(id_, faces_detected and tags_detected) for id_, faces_detected, tags_detected in query]
+
         @classmethod
         def get_all_images(cls):
             return cls.select()
@@ -43,6 +155,62 @@ def get_database(database_path):
         def get_tags(cls, image_id):
             return cls.get_image_if_exists(id=image_id).tags
 
+    class ImageFileStat(IllusionDb):
+        # stat signature of the file at the time md5 was computed, the file is hashed again only if it changes
+        image = pw.ForeignKeyField(
+            Image, backref="file_stat", primary_key=True, on_delete="CASCADE", on_update="CASCADE"
+        )
+        size = pw.BigIntegerField()
+        mtime_ns = pw.BigIntegerField()
+        inode = pw.BigIntegerField()
+
+        @classmethod
+        def set_stats(cls, rows):
+            """
+            :param rows: list of (image id, size, mtime_ns, inode)
+            """
+            with pw_database.atomic():
+                for rows_chunk in pw.chunked(rows, SQLITE_MAX_VARIABLES // 4):
+                    cls.insert_many(
+                        rows_chunk, fields=[cls.image, cls.size, cls.mtime_ns, cls.inode]
+                    ).on_conflict_replace().execute()
+
+    class ImageFingerprint(IllusionDb):
+        # difference hash and coarse color histogram for near duplicate search
+        image = pw.ForeignKeyField(
+            Image, backref="fingerprint", primary_key=True, on_delete="CASCADE", on_update="CASCADE"
+        )
+        dhash = pw.BigIntegerField()  # 64 bit hash stored as signed integer
+        color_histogram = pw.BlobField()
+
+        @staticmethod
+        def _to_signed(dhash):
+            return dhash - (1 << 64) if dhash >= (1 << 63) else dhash
+
+        @classmethod
+        def set_fingerprint(cls, image_id, dhash, color_histogram):
+            cls.insert(
+                image=image_id, dhash=cls._to_signed(dhash), color_histogram=bytes(color_histogram)
+            ).on_conflict_replace().execute()
+
+        @classmethod
+        def copy_fingerprint(cls, source_id, target_id):
+            cls.insert_from(
+                cls.select(pw.Value(target_id), cls.dhash, cls.color_histogram).where(cls.image == source_id),
+                fields=[cls.image, cls.dhash, cls.color_histogram]
+            ).on_conflict_replace().execute()
+
+        @classmethod
+        def get_fingerprints(cls, image_ids=None):
+            """
+            :return: generator of (image id, unsigned dhash, color histogram bytes)
+            """
+            query = cls.select(cls.image_id, cls.dhash, cls.color_histogram)
+            if image_ids is not None:
+                query = query.where(cls.image_id.in_(image_ids))
+            for image_id, dhash, color_histogram in query.tuples().iterator():
+                yield image_id, dhash & ((1 << 64) - 1), bytes(color_histogram)
+
     class Tag(IllusionDb):
         id = pw.AutoField()
         name = pw.CharField(index=True)
@@ -71,6 +239,26 @@ def get_database(database_path):
                 tag = cls.create(name=name)
             return tag
 
+        @classmethod
+        def get_or_create_many(cls, names):
+            """
+            Selects existing tags and inserts the missing ones in bulk
+            :param names: iterable of tag names
+            :return: dict name -> tag id
+            """
+            names = set(names)
+            tag_ids = {}
+            with pw_database.atomic():
+                for names_chunk in pw.chunked(names, SQLITE_MAX_VARIABLES):
+                    tag_ids.update(cls.select(cls.name, cls.id).where(cls.name.in_(names_chunk)).tuples())
+                missing = [(name,) for name in names if name not in tag_ids]
+                if len(missing) > 0:
+                    for rows_chunk in pw.chunked(missing, SQLITE_MAX_VARIABLES):
+                        cls.insert_many(rows_chunk, fields=[cls.name]).execute()
+                    for names_chunk in pw.chunked([name for name, in missing], SQLITE_MAX_VARIABLES):
+                        tag_ids.update(cls.select(cls.name, cls.id).where(cls.name.in_(names_chunk)).tuples())
+            return tag_ids
+
     class Person(IllusionDb):
         id = pw.IntegerField(primary_key=True)
         name = pw.CharField(index=True, null=True)
@@ -104,6 +292,26 @@ def get_database(database_path):
                 image=image, thumbnail_path=thumbnail_path, x=x, y=y, w=w, h=h
             )
 
+        @classmethod
+        def create_faces(cls, rows):
+            """
+            Inserts many faces, call inside a transaction
+            :param rows: list of (image id, thumbnail path string, x, y, w, h)
+            :return: list of ids of the new faces in the order of rows
+            """
+            fields = [cls.image, cls.thumbnail_path, cls.x, cls.y, cls.w, cls.h]
+            if sqlite3.sqlite_version_info < (3, 35, 0):
+                # no RETURNING clause, one statement per face
+                return [cls.insert(dict(zip(fields, row))).execute() for row in rows]
+            face_ids = []
+            for rows_chunk in pw.chunked(rows, SQLITE_MAX_VARIABLES // len(fields)):
+                # RETURNING order is unspecified, but rowids are assigned increasing in the order of rows
+                face_ids.extend(sorted(
+                    face_id for face_id, in cls.insert_many(rows_chunk, fields=fields).returning(cls.id).tuples()
+                    .execute()
+                ))
+            return face_ids
+
     class FacePerson(IllusionDb):
         face = pw.ForeignKeyField(Face, backref="person", on_delete="CASCADE", on_update="CASCADE")
         person = pw.ForeignKeyField(Person, backref="faces", on_delete="CASCADE", on_update="CASCADE")
@@ -124,6 +332,15 @@ def get_database(database_path):
             )
             primary_key = False
 
+        @classmethod
+        def add_tags(cls, image_id, tag_ids):
+            """
+            Associates tags with an image, associations that already exist are skipped
+            """
+            rows = [(image_id, tag_id) for tag_id in tag_ids]
+            for rows_chunk in pw.chunked(rows, SQLITE_MAX_VARIABLES // 2):
+                cls.insert_many(rows_chunk, fields=[cls.image, cls.tag]).on_conflict_ignore().execute()
+
     class FaceSimilarity(IllusionDb):
         face = pw.ForeignKeyField(Face, backref="similar_to", on_delete="CASCADE", on_update="CASCADE")
         similar_to = pw.ForeignKeyField(Face, backref="similar_to", on_delete="CASCADE", on_update="CASCADE")
@@ -136,9 +353,10 @@ def get_database(database_path):
 
     def create_tables():
         pw_database.create_tables([
-            Image, Tag, Person, Face, ImageTag, FacePerson
+            Image, Tag, Person, Face, ImageTag, FacePerson, ImageFileStat, ImageFingerprint
         ])
 
-    create_tables()
+    if not read_only:
+        create_tables()
 
-    return Image, Tag, Person, Face, ImageTag, FacePerson
+    return Image, Tag, Person, Face, ImageTag, FacePerson, ImageFileStat, ImageFingerprint
@@ -1,22 +1,91 @@
+import copyreg
 import hashlib
+import os
+import queue
+import stat
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from typing import List, Union
 
 import cv2
+import numpy as np
+import peewee as pw
 
 from image_store import get_database
-from old_illusion.protocol import Message, AbstractWorker
+from image_store.near_duplicate_index import NearDuplicateIndex
+from image_store.thumbnail_store import PackedThumbnailStore, FACE_THUMBNAILS_FILE
+from old_illusion.protocol import Message, AbstractWorker, SharedArray
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def file_md5(path):
+    """
+    Hashes the file through a fixed size buffer, memory use does not depend on the file size
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as image_file:
+        while True:
+            read = image_file.readinto(buffer)
+            if not read:
+                break
+            md5.update(view[:read])
+    return md5.hexdigest()
+
+
+def _hash_if_file(path: Path):
+    try:
+        return file_md5(path)
+    except FileNotFoundError:
+        return None
+
+
+def _stat_if_file(path: Path):
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return file_stat if stat.S_ISREG(file_stat.st_mode) else None
 
 
 class DatamodelObject:
+    """
+    Objects are sent between processes in every message, so they keep attributes in slots and are pickled
+    as a tuple of values. Subclasses decide how every value is sent in _get_state and restored in __setstate__
+    """
+    __slots__ = ()
+
     def __repr__(self):
-        content_string = ', '.join(f"{key}: {value}" for key, value in self.__dict__.items())
+        content_string = ', '.join(f"{key}: {getattr(self, key)}" for key in self.__slots__)
         return f"{self.__class__.__name__}({content_string})"
 
+    def _get_state(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+
+    def __reduce__(self):
+        return copyreg.__newobj__, (self.__class__,), self._get_state()
+
 
 class Image(DatamodelObject):
-    def __init__(self, id=None, path=None, md5=None, faces_detected=None, tags_detected=None, tags=None, faces=None):
+    __slots__ = (
+        "id", "path", "md5", "faces_detected", "faces", "tags", "tags_detected", "fingerprinted", "dhash",
+        "color_histogram", "was_updated"
+    )
+
+    def __init__(
+            self, id=None, path=None, md5=None, faces_detected=None, tags_detected=None, tags=None, faces=None,
+            fingerprinted=None
+    ):
         self.id = id
         self.path = path
         self.md5 = md5
@@ -24,6 +93,10 @@ class Image(DatamodelObject):
         self.faces = faces
         self.tags = tags
         self.tags_detected = tags_detected
+        self.fingerprinted = fingerprinted
+        # fingerprint is only carried from the analyzer to the image store
+        self.dhash = None
+        self.color_histogram = None
         self.was_updated = False
 
         if self.path is not None and isinstance(self.path, str):
@@ -46,6 +119,12 @@ class Image(DatamodelObject):
     def set_tags_detected_flag(self):
         self.tags_detected = True
 
+    def set_fingerprint(self, dhash, color_histogram):
+        self.dhash = dhash
+        self.color_histogram = color_histogram
+        self.fingerprinted = True
+        self.was_updated = True
+
     def read_image_content(self):
         """
         Read image from the disk
@@ -58,16 +137,32 @@ class Image(DatamodelObject):
     # def __repr__(self):
     #     return f"Image({self.__dict__})"
 
+    def _get_state(self):
+        # path is sent as a string, it is much shorter pickled than a Path
+        return tuple(str(value) if key == "path" and value is not None else value
+                     for key, value in zip(self.__slots__, super()._get_state()))
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.path is not None:
+            self.path = Path(self.path)
+
     @classmethod
     def from_datamodel(cls, image):
         return cls(
             id=image.id, path=image.path, md5=image.md5, faces_detected=image.faces_detected,
             tags_detected=image.tags_detected,
-            tags={t.tag.name for t in image.tags}, faces=[Face.from_datamodel(face) for face in image.faces]
+            tags={t.tag.name for t in image.tags}, faces=[Face.from_datamodel(face) for face in image.faces],
+            fingerprinted=image.fingerprint.exists()
         )
 
 
 class Face(DatamodelObject):
+    __slots__ = (
+        "id", "image_id", "x", "y", "w", "h", "_thumbnail", "thumbnail_path", "deleted", "person", "recognized",
+        "send_thumbnail"
+    )
+
     def __init__(
             self, id, x, y, w, h, deleted, person, thumbnail_path=None, thumbnail=None, image_id=None, recognized=False
     ):
@@ -82,6 +177,8 @@ class Face(DatamodelObject):
         self.deleted = deleted
         self.person = person
         self.recognized = recognized
+        # thumbnails of stored faces are read from the thumbnail store, they are only sent when requested
+        self.send_thumbnail = False
 
         if self.thumbnail_path is not None and isinstance(self.thumbnail_path, str):
             self.thumbnail_path = Path(self.thumbnail_path)
@@ -92,19 +189,61 @@ class Face(DatamodelObject):
     def set_person_identified_flag(self):
         self.recognized = True
 
+    def set_send_thumbnail_flag(self):
+        self.send_thumbnail = True
+
     # def __repr__(self):
     #     return f"Face({self.__dict__})"
 
-    def get_thumbnail(self):
+    def _get_state(self):
+        state = dict(zip(self.__slots__, super()._get_state()))
+        if self.id is not None and not self.send_thumbnail:
+            # face is stored, the receiver reads the thumbnail from the thumbnail store
+            state["_thumbnail"] = None
+        elif isinstance(state["_thumbnail"], np.memmap):
+            # views into the packed thumbnail file are sent as plain arrays
+            state["_thumbnail"] = np.array(state["_thumbnail"])
+        if self.thumbnail_path is not None:
+            state["thumbnail_path"] = str(self.thumbnail_path)
+        return tuple(state.values())
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.thumbnail_path is not None:
+            self.thumbnail_path = Path(self.thumbnail_path)
+
+    def get_thumbnail(self, thumbnail_store=None):
+        """
+        :param thumbnail_store: PackedThumbnailStore, used for faces without a thumbnail file
+        """
         if self._thumbnail is None:
-            self._thumbnail = cv2.imread(str(self.thumbnail_path.resolve()))
+            if self.thumbnail_path is not None:
+                # thumbnails saved as separate files before the packed store was introduced
+                self._thumbnail = cv2.imread(str(self.thumbnail_path.resolve()))
+            elif thumbnail_store is not None and self.id is not None:
+                self._thumbnail = thumbnail_store.read(self.id)
         return self._thumbnail
 
-    def save_thumbnail(self, save_dir: Path):
-        thumbnail_name = f"{hashlib.md5(self._thumbnail.tobytes()).hexdigest()}.jpeg"
-        self.thumbnail_path = save_dir.joinpath(thumbnail_name)
-        # self.thumbnail_path = join(save_dir, thumbnail_name)
-        cv2.imwrite(str(self.thumbnail_path.resolve()), self._thumbnail)
+    def share_thumbnail(self, shared_array: SharedArray):
+        """
+        Thumbnail was copied to shared memory, only the handle is sent with the face
+        """
+        self._thumbnail = shared_array
+
+    def write_thumbnail(self, thumbnail_store, shared_memory_pool=None):
+        if isinstance(self._thumbnail, SharedArray):
+            thumbnail_store.write(self.id, shared_memory_pool.get_array(self._thumbnail))
+            self.release_thumbnail(shared_memory_pool)
+        else:
+            thumbnail_store.write(self.id, self._thumbnail)
+
+    def release_thumbnail(self, shared_memory_pool):
+        """
+        Returns shared memory of the thumbnail to the pool, the handle is dropped and not sent any further
+        """
+        if isinstance(self._thumbnail, SharedArray):
+            shared_memory_pool.release(self._thumbnail)
+            self._thumbnail = None
 
     @classmethod
     def from_datamodel(cls, face):
@@ -123,6 +262,8 @@ class Face(DatamodelObject):
 
 
 class Person(DatamodelObject):
+    __slots__ = ("id", "name", "image_ids")
+
     def __init__(self, id, name, image_ids=None):
         self.id = id
         self.name = name
@@ -142,76 +283,353 @@ class Person(DatamodelObject):
 
 
 class ImageStore(AbstractWorker):
+    EXISTING_IMAGES_CHUNK_SIZE = 1000
+    WAL_CHECKPOINT_SIZE = 64 * 1024 * 1024  # bytes, the log is truncated once it grows past this
+    UPDATE_GROUP_DELAY = 0.05  # seconds to wait for more UPDATE_METADATA messages before committing a group
+    UPDATE_GROUP_SIZE = 256  # messages, the group is committed as soon as this many arrived
 
     class InboxTypes(Enum):
         GET_EXISTING_IMAGES = 1  # request to send all existing images arrived
         ADD_NEW_IMAGES = 2  # new images have arrived
         UPDATE_METADATA = 3
+        STREAM_EXISTING_IMAGES = 4  # send all existing images in chunks, content is the chunk size or None
+        FIND_NEAR_DUPLICATES = 5  # content is an image id
+        GET_NEAR_DUPLICATE_GROUPS = 6
 
     class OutboxTypes(Enum):
         EXISTING_IMAGES = 1  # sending existing images
         ADDED_IMAGES = 2  # sending images that have been added
         UPDATED_METADATA = 3
+        EXISTING_IMAGES_CHUNK = 4  # sending a chunk of existing images
+        EXISTING_IMAGES_END = 5  # all chunks of existing images were sent
+        NEAR_DUPLICATES = 6  # sending (image id, list of (near duplicate image id, hamming distance))
+        NEAR_DUPLICATE_GROUPS = 7  # sending lists of ids of images that are near duplicates of each other
 
-    def __init__(self, config, inbox_queue, outbox_queue):
+    def __init__(self, config, inbox_queue, outbox_queue, shared_memory_pool=None):
         self.config = config
         self.inbox_queue = inbox_queue
         self.outbox_queue = outbox_queue
+        self._shared_memory_pool = shared_memory_pool
         self.ImageTable, self.TagTable, self.PersonTable, \
-            self.FaceTable, self.ImageTagTable, self.FacePersonTable = \
-            get_database(config.db_loc)
+            self.FaceTable, self.ImageTagTable, self.FacePersonTable, self.ImageFileStatTable, \
+            self.ImageFingerprintTable = get_database(config.db_loc, storage_profile=config.storage_profile)
+        # catalog loads use a separate set of models bound to read only connections
+        self.ImageReadTable, self.TagReadTable, self.PersonReadTable, \
+            self.FaceReadTable, self.ImageTagReadTable, self.FacePersonReadTable, _, \
+            self.ImageFingerprintReadTable = \
+            get_database(
+                config.db_loc, storage_profile=config.storage_profile, read_only=True,
+                max_connections=config.db_readers
+            )
+        self._read_database = self.ImageReadTable._meta.database
+        self._wal_path = Path(f"{config.db_loc}-wal")
+        # hashing releases the GIL, so reads and digests of several files overlap
+        self._hash_executor = ThreadPoolExecutor(max_workers=config.hash_workers)
+        # catalog loads run here while the worker keeps writing metadata
+        self._read_executor = ThreadPoolExecutor(max_workers=config.db_readers)
+        self._running_reads = 0
+        self._running_reads_lock = threading.Lock()
+        self._face_thumbnails = PackedThumbnailStore(config.face_thumbnails_loc.joinpath(FACE_THUMBNAILS_FILE))
+        # tag name -> id, tags are never renamed or deleted, so entries do not go stale
+        self._tag_ids = {}
+        self._near_duplicates = NearDuplicateIndex()
+        for image_id, dhash, color_histogram in self.ImageFingerprintTable.get_fingerprints():
+            self._near_duplicates.add(image_id, dhash, color_histogram)
 
     def _add_images(self, paths):
-        added = []
+        file_stats = {}
         for image_path in paths:
-            new_id = self._add_image(image_path)
-            if new_id is not None:
-                added.append(new_id)
+            file_stat = _stat_if_file(image_path)
+            if file_stat is not None:
+                file_stats[str(image_path.resolve())] = file_stat
+
+        # files whose stat signature matches the one recorded with their md5 are not read at all
+        existing = self.ImageTable.get_existing_with_file_stat(list(file_stats))
+        to_hash = [
+            path for path, file_stat in file_stats.items()
+            if path not in existing
+            or existing[path][1] != (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        ]
+        hashes = dict(zip(to_hash, self._hash_executor.map(_hash_if_file, [Path(path) for path in to_hash])))
+        hashes = {path: md5 for path, md5 in hashes.items() if md5 is not None}
+
+        with self.ImageTable._meta.database.atomic():
+            for path, md5 in hashes.items():
+                if path in existing:
+                    # TODO
+                    # This could be an issue when an image with the same name was added
+                    # but the image itself has changed. GUI will not be notified
+                    self.ImageTable.update(md5=md5).where(self.ImageTable.id == existing[path][0]).execute()
+
+            created = self.ImageTable.create_images(
+                [(path, md5) for path, md5 in hashes.items() if path not in existing]
+            )
 
-        return added
+            image_ids = {path: existing[path][0] for path in hashes if path in existing}
+            image_ids.update(created)
+            self.ImageFileStatTable.set_stats([
+                (image_ids[path], file_stats[path].st_size, file_stats[path].st_mtime_ns, file_stats[path].st_ino)
+                for path in hashes
+            ])
 
-    def _add_image(self, path: Path):
-        if path.is_file():
-            md5 = hashlib.md5(open(path, 'rb').read()).hexdigest()
-        else:
-            return None
-            # raise FileNotFoundError(f"File nod found: {path}")
-
-        image = self.ImageTable.get_image_if_exists(path=path)
-        if image is not None:
-            image.md5 = md5
-            image.save()
-            # TODO
-            # This could be an issue when an image with the same name was added
-            # but the image itself has changed. GUI will not be notified
-            return None
-        else:
-            image = self.ImageTable.create_image(path=path, md5=md5)
-            return Image.from_datamodel(image)
+            # copies of already analyzed content are not sent to the analyzer
+            reused = self._reuse_analysis({image_id: hashes[path] for path, image_id in created.items()})
+
+        return [
+            reused[image_id] if image_id in reused else Image(
+                id=image_id, path=path, md5=hashes[path], faces_detected=False, tags_detected=False,
+                tags=set(), faces=[], fingerprinted=False
+            )
+            for path, image_id in created.items()
+        ]
+
+    def _copy_analysis(self, source_id, target_ids):
+        """
+        Copies tags, faces and persons of faces of an analyzed image to images with identical content.
+        Thumbnail files of faces are shared with the source, packed thumbnails are copied to the new face ids
+        """
+        tag_ids = [
+            tag_id for tag_id, in self.ImageTagTable.select(self.ImageTagTable.tag_id)
+            .where(self.ImageTagTable.image_id == source_id)
+            .tuples()
+        ]
+        source_faces = list(
+            self.FaceTable.select().where(self.FaceTable.image_id == source_id).order_by(self.FaceTable.id)
+        )
+        face_persons = dict(
+            self.FacePersonTable.select(self.FacePersonTable.face_id, self.FacePersonTable.person_id)
+            .join_from(self.FacePersonTable, self.FaceTable)
+            .where(self.FaceTable.image_id == source_id)
+            .tuples()
+        )
+
+        for target_id in target_ids:
+            self.ImageTagTable.add_tags(target_id, tag_ids)
+            self.ImageFingerprintTable.copy_fingerprint(source_id, target_id)
+            face_ids = self.FaceTable.create_faces([
+                (target_id, face.thumbnail_path, face.x, face.y, face.w, face.h) for face in source_faces
+            ])
+            copied = list(zip(source_faces, face_ids))
+            for face, face_id in copied:
+                if face.thumbnail_path is None:
+                    self._face_thumbnails.copy(face.id, face_id)
+            self.FacePersonTable.insert_many(
+                [(face_id, face_persons[face.id]) for face, face_id in copied if face.id in face_persons],
+                fields=[self.FacePersonTable.face, self.FacePersonTable.person]
+            ).execute()
+            for flag in ("deleted", "recognized"):
+                flagged = [face_id for face, face_id in copied if getattr(face, flag)]
+                if len(flagged) > 0:
+                    self.FaceTable.update({flag: True}).where(self.FaceTable.id.in_(flagged)).execute()
+
+        self.ImageTable.update(faces_detected=True, tags_detected=True) \
+            .where(self.ImageTable.id.in_(target_ids)).execute()
+        for image_id, dhash, color_histogram in self.ImageFingerprintTable.get_fingerprints(target_ids):
+            self._near_duplicates.add(image_id, dhash, color_histogram)
+
+    def _copy_fingerprint(self, source_id, target_ids):
+        """
+        Copies the fingerprint to analyzed images with identical content that were stored before fingerprints
+        existed, only one image per md5 is sent to the analyzer
+        """
+        for target_id in target_ids:
+            self.ImageFingerprintTable.copy_fingerprint(source_id, target_id)
+        for image_id, dhash, color_histogram in self.ImageFingerprintTable.get_fingerprints(target_ids):
+            self._near_duplicates.add(image_id, dhash, color_histogram)
+
+    def _reuse_analysis(self, image_md5s):
+        """
+        Images whose md5 matches an analyzed image receive a copy of its results, call inside a transaction
+        :param image_md5s: dict image id -> md5 of images that are not analyzed yet
+        :return: dict image id -> Image for the images that received results
+        """
+        targets = {}
+        for image_id, md5 in image_md5s.items():
+            targets.setdefault(md5, []).append(image_id)
+
+        reused = {}
+        for md5, source_id in self.ImageTable.get_analyzed_with_md5(list(targets)).items():
+            self._copy_analysis(source_id, targets[md5])
+            for image_id in targets[md5]:
+                reused[image_id] = Image.from_datamodel(self.ImageTable.get_by_id(image_id))
+        return reused
+
+    def _load_images(self, min_id=None, max_id=None):
+        """
+        Materializes images with their tags, faces and persons in a constant number of queries on a read only
+        connection. Callers run it in a transaction, so all queries see the same committed state
+        Related rows are selected by image id range rather than by IN lists, so the same queries serve
+        the whole catalog and id ranged chunks of it
+        :param min_id: smallest image id to load, inclusive
+        :param max_id: largest image id to load, inclusive
+        """
+        def in_range(image_id_field):
+            condition = True
+            if min_id is not None:
+                condition = condition & (image_id_field >= min_id)
+            if max_id is not None:
+                condition = condition & (image_id_field <= max_id)
+            return condition
+
+        image_tags = {}
+        tags_query = (
+            self.ImageTagReadTable.select(self.ImageTagReadTable.image_id, self.TagReadTable.name)
+            .join(self.TagReadTable)
+            .where(in_range(self.ImageTagReadTable.image_id))
+            .tuples()
+        )
+        for image_id, tag_name in tags_query:
+            image_tags.setdefault(image_id, set()).add(tag_name)
+
+        face_persons = {}
+        face_persons_query = (
+            self.FacePersonReadTable.select(self.FacePersonReadTable.face_id, self.FacePersonReadTable.person_id)
+            .join_from(self.FacePersonReadTable, self.FaceReadTable)
+            .where(in_range(self.FaceReadTable.image_id))
+            .tuples()
+        )
+        for face_id, person_id in face_persons_query:
+            face_persons.setdefault(face_id, []).append(person_id)
+
+        # image ids of every person seen in the range, computed once instead of per face
+        persons_in_range = (
+            self.FacePersonReadTable.select(self.FacePersonReadTable.person_id)
+            .join_from(self.FacePersonReadTable, self.FaceReadTable)
+            .where(in_range(self.FaceReadTable.image_id))
+        )
+        person_image_ids = {}
+        person_images_query = (
+            self.FacePersonReadTable.select(self.FacePersonReadTable.person_id, self.FaceReadTable.image_id)
+            .join_from(self.FacePersonReadTable, self.FaceReadTable)
+            .where(self.FacePersonReadTable.person_id.in_(persons_in_range))
+            .tuples()
+        )
+        for person_id, image_id in person_images_query:
+            person_image_ids.setdefault(person_id, []).append(image_id)
+
+        persons = {
+            person_id: Person(id=person_id, name=name, image_ids=person_image_ids.get(person_id, []))
+            for person_id, name in self.PersonReadTable.select(self.PersonReadTable.id, self.PersonReadTable.name)
+            .where(self.PersonReadTable.id.in_(persons_in_range))
+            .tuples()
+        }
+
+        image_faces = {}
+        for face in self.FaceReadTable.select().where(in_range(self.FaceReadTable.image_id)):
+            person_ids = face_persons.get(face.id, [])
+            if len(person_ids) > 1:
+                raise Exception()
+            image_faces.setdefault(face.image_id, []).append(Face(
+                id=face.id, x=face.x, y=face.y, w=face.w, h=face.h, deleted=face.deleted,
+                thumbnail_path=face.thumbnail_path, person=persons[person_ids[0]] if person_ids else None,
+                image_id=face.image_id, recognized=face.recognized
+            ))
+
+        return [
+            Image(
+                id=image.id, path=image.path, md5=image.md5, faces_detected=image.faces_detected,
+                tags_detected=image.tags_detected,
+                tags=image_tags.get(image.id, set()), faces=image_faces.get(image.id, []),
+                fingerprinted=image.fingerprint_id is not None
+            )
+            for image in self.ImageReadTable.select(
+                self.ImageReadTable, self.ImageFingerprintReadTable.image_id.alias("fingerprint_id")
+            )
+            .join(self.ImageFingerprintReadTable, pw.JOIN.LEFT_OUTER)
+            .where(in_range(self.ImageReadTable.id))
+            .order_by(self.ImageReadTable.id)
+            .objects()
+        ]
+
+    def _stream_existing_images(self, chunk_size=None):
+        """
+        Sends the catalog in chunks ordered by id followed by EXISTING_IMAGES_END. Chunks are selected with keyset
+        pagination (id > last sent id), so every chunk costs the same regardless of its position, and only one
+        chunk is held in memory at a time
+        """
+        if chunk_size is None:
+            chunk_size = self.EXISTING_IMAGES_CHUNK_SIZE
+
+        last_id = 0
+        # the connection goes back to the pool when the stream ends
+        with self._read_database.connection_context():
+            while True:
+                chunk_ids = [
+                    image_id for image_id, in self.ImageReadTable.select(self.ImageReadTable.id)
+                    .where(self.ImageReadTable.id > last_id)
+                    .order_by(self.ImageReadTable.id)
+                    .limit(chunk_size)
+                    .tuples()
+                ]
+                if len(chunk_ids) == 0:
+                    break
+                with self._read_database.atomic():
+                    images = self._load_images(min_id=chunk_ids[0], max_id=chunk_ids[-1])
+                self.outbox_queue.put(Message(ImageStore.OutboxTypes.EXISTING_IMAGES_CHUNK, content=images))
+                last_id = chunk_ids[-1]
+
+        self.outbox_queue.put(Message(ImageStore.OutboxTypes.EXISTING_IMAGES_END, content=None))
+
+    def _send_existing_images(self):
+        with self._read_database.connection_context(), self._read_database.atomic():
+            images = self._load_images()
+        self.outbox_queue.put(Message(ImageStore.OutboxTypes.EXISTING_IMAGES, content=images))
+
+    def _read_in_background(self, read_fn, *args):
+        def read_done(future):
+            with self._running_reads_lock:
+                self._running_reads -= 1
+            error = future.exception()
+            if error is not None:
+                traceback.print_exception(type(error), error, error.__traceback__)
+
+        with self._running_reads_lock:
+            self._running_reads += 1
+        self._read_executor.submit(read_fn, *args).add_done_callback(read_done)
+
+    def _maybe_checkpoint(self):
+        """
+        Automatic checkpoints cannot reset the log while catalog reads are in progress, so during long ingests
+        it keeps growing. Once it is over WAL_CHECKPOINT_SIZE it is truncated. Truncation waits for readers of older
+        snapshots up to busy_timeout, which would stall every write while a catalog load runs, so in that case only
+        the frames no reader needs are copied back and truncation is left for when the loads finish
+        """
+        try:
+            wal_size = self._wal_path.stat().st_size
+        except FileNotFoundError:
+            return
+        if wal_size > self.WAL_CHECKPOINT_SIZE:
+            with self._running_reads_lock:
+                mode = "PASSIVE" if self._running_reads > 0 else "TRUNCATE"
+            self.ImageTable._meta.database.execute_sql(f"PRAGMA wal_checkpoint({mode})")
+
+    def _get_tag_ids(self, tag_names):
+        missing = [name for name in tag_names if name not in self._tag_ids]
+        if len(missing) > 0:
+            self._tag_ids.update(self.TagTable.get_or_create_many(missing))
+        return [self._tag_ids[name] for name in tag_names]
 
     def _update_image_metadata(self, image: Image):
         if image.was_updated:
             pw_image = self.ImageTable.get_image_if_exists(image.id)
             if pw_image.tags_detected is False and image.tags_detected is True:
-                # {t.tag.name for t in self._image.tags}
-                for tag in image.tags:  # TODO check for duplicates
-                    pw_tag = self.TagTable.get_or_create(tag)
-                    self.ImageTagTable.create(image=pw_image, tag=pw_tag)
-                    pw_tag.save()
+                self.ImageTagTable.add_tags(pw_image.id, self._get_tag_ids(image.tags))
                 pw_image.tags_detected = True
 
             if pw_image.faces_detected is False and image.faces_detected is True:
-                for face in image.faces:
-                    if face.id is not None:
-                        continue
-                    face.save_thumbnail(save_dir=self.config.face_thumbnails_loc)
-                    pw_face = self.FaceTable.create_face(
-                        image=pw_image, thumbnail_path=face.thumbnail_path,
-                        x=face.x, y=face.y, w=face.w, h=face.h
-                    )
-                    face.id = pw_face.id
-                    pw_face.save()
+                new_faces = [face for face in image.faces if face.id is None]
+                # thumbnails are addressed by face id, so rows are created first
+                face_ids = self.FaceTable.create_faces([
+                    (pw_image.id, None, face.x, face.y, face.w, face.h) for face in new_faces
+                ])
+                for face, face_id in zip(new_faces, face_ids):
+                    face.id = face_id
+                    face.write_thumbnail(self._face_thumbnails, self._shared_memory_pool)
                 pw_image.faces_detected = True
+
+            if image.fingerprinted is True and image.dhash is not None:
+                self.ImageFingerprintTable.set_fingerprint(pw_image.id, image.dhash, image.color_histogram)
+                self._near_duplicates.add(pw_image.id, image.dhash, image.color_histogram)
             pw_image.save()
             return image
         return None
@@ -233,6 +651,9 @@ class ImageStore(AbstractWorker):
         for updated_object in updated_objects:
             if isinstance(updated_object, Image):
                 updated_ = self._update_image_metadata(updated_object)
+                # faces that were not written, e.g. when the image was already analyzed, still hold shared memory
+                for face in updated_object.faces:
+                    face.release_thumbnail(self._shared_memory_pool)
             elif isinstance(updated_object, Face):
                 updated_ = self._update_face_metadata(updated_object)
             else:
@@ -240,26 +661,98 @@ class ImageStore(AbstractWorker):
             if updated_ is not None:
                 updated.append(updated_object)
 
+            if isinstance(updated_, Image) and updated_.faces_detected and updated_.tags_detected:
+                # copies that arrived before this image was analyzed were not sent to the analyzer
+                not_analyzed, not_fingerprinted = {}, []
+                for image_id, fingerprint_missing in self.ImageTable.get_not_analyzed_with_md5(updated_.md5):
+                    if image_id == updated_.id:
+                        continue
+                    if fingerprint_missing:
+                        not_fingerprinted.append(image_id)
+                    else:
+                        not_analyzed[image_id] = updated_.md5
+                updated.extend(self._reuse_analysis(not_analyzed).values())
+                # their faces and tags did not change, so they are not sent to the app
+                self._copy_fingerprint(updated_.id, not_fingerprinted)
+
         return updated
 
+    def _update_metadata_group(self, updates):
+        """
+        Applies several UPDATE_METADATA messages in one transaction, so the group costs a single commit
+        :param updates: list of message contents
+        :return: UPDATED_METADATA response for every message, to be sent after the commit
+        """
+        with self.ImageTable._meta.database.atomic():
+            return [
+                Message(ImageStore.OutboxTypes.UPDATED_METADATA, self._update_metadata(updated_objects))
+                for updated_objects in updates
+            ]
+
+    def _commit_update_group(self, message):
+        """
+        Collects UPDATE_METADATA messages arriving within UPDATE_GROUP_DELAY and commits them together
+        :param message: first UPDATE_METADATA message of the group
+        :return: message that ended the group, None if the group ended by timeout or size
+        """
+        group = [message]
+        next_message = None
+        deadline = time.monotonic() + self.UPDATE_GROUP_DELAY
+        while len(group) < self.UPDATE_GROUP_SIZE:
+            try:
+                next_message = self.inbox_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if next_message.descriptor != ImageStore.InboxTypes.UPDATE_METADATA:
+                break
+            group.append(next_message)
+            next_message = None
+
+        for response in self._update_metadata_group([update.content for update in group]):
+            self.outbox_queue.put(response)
+        self._maybe_checkpoint()
+        return next_message
+
+    def handle_incoming(self):
+        message = self.inbox_queue.get()
+        if message.descriptor == ImageStore.InboxTypes.UPDATE_METADATA:
+            # any other message ends the group and is handled after the group is committed
+            message = self._commit_update_group(message)
+            if message is None:
+                return
+        response = self._handle_message(message)
+        if response is not None:
+            self.outbox_queue.put(response)
+
     def _handle_message(self, message):
         if message.descriptor == ImageStore.InboxTypes.GET_EXISTING_IMAGES:
-            images = [Image.from_datamodel(image) for image in self.ImageTable.get_all_images()]
-            return Message(
-                ImageStore.OutboxTypes.EXISTING_IMAGES,
-                content=images
-            )
+            # responses of catalog loads are put into the outbox by the reader thread
+            self._read_in_background(self._send_existing_images)
+            return None
+        elif message.descriptor == ImageStore.InboxTypes.STREAM_EXISTING_IMAGES:
+            self._read_in_background(self._stream_existing_images, message.content)
+            return None
         elif message.descriptor == ImageStore.InboxTypes.ADD_NEW_IMAGES:
-            return Message(
+            response = Message(
                 ImageStore.OutboxTypes.ADDED_IMAGES,
                 content=self._add_images(message.content)
             )
         elif message.descriptor == ImageStore.InboxTypes.UPDATE_METADATA:
+            response, = self._update_metadata_group([message.content])
+        elif message.descriptor == ImageStore.InboxTypes.FIND_NEAR_DUPLICATES:
             return Message(
-                ImageStore.OutboxTypes.UPDATED_METADATA,
-                self._update_metadata(message.content)
+                ImageStore.OutboxTypes.NEAR_DUPLICATES,
+                content=(message.content, self._near_duplicates.find_near_duplicates(message.content))
             )
-        return None
+        elif message.descriptor == ImageStore.InboxTypes.GET_NEAR_DUPLICATE_GROUPS:
+            return Message(
+                ImageStore.OutboxTypes.NEAR_DUPLICATE_GROUPS,
+                content=self._near_duplicates.near_duplicate_groups()
+            )
+        else:
+            return None
+        self._maybe_checkpoint()
+        return response
 
 
 # def start_image_store(config, inbox_queue, outbox_queue):
@@ -0,0 +1,137 @@
+from itertools import combinations
+
+import numpy as np
+
+HASH_BITS = 64
+NUM_BANDS = 4
+MAX_HAMMING_DISTANCE = 6  # bits of the difference hash that may differ between near duplicates
+MAX_HISTOGRAM_DISTANCE = 64  # L1 distance between color histograms normalized to 255
+
+
+def _as_histogram(histogram):
+    # accepts the uint8 array computed by the analyzer and the bytes stored in the database
+    if not isinstance(histogram, np.ndarray):
+        histogram = np.frombuffer(histogram, dtype=np.uint8)
+    return histogram.astype(np.int16)
+
+
+class NearDuplicateIndex:
+    """
+    Multi-index hashing over 64 bit difference hashes. The hash is split into bands, and every band is a hash
+    table from the band value to image ids. Two hashes within max_distance bits of each other differ in at most
+    max_distance // num_bands bits in one of the bands, so a query looks up band values within that distance
+    and only compares the images found there instead of the whole library. Candidates are confirmed with
+    the exact hamming distance and the color histogram
+    """
+
+    def __init__(
+            self, max_distance=MAX_HAMMING_DISTANCE, max_histogram_distance=MAX_HISTOGRAM_DISTANCE,
+            num_bands=NUM_BANDS
+    ):
+        self.max_distance = max_distance
+        self.max_histogram_distance = max_histogram_distance
+
+        band_edges = [HASH_BITS * band // num_bands for band in range(num_bands + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(band_edges, band_edges[1:])]
+        self._tables = [{} for _ in self._bands]
+        # masks of every bit combination a band value may differ in
+        band_radius = max_distance // num_bands
+        self._flip_masks = [
+            [
+                sum(1 << bit for bit in bits)
+                for radius in range(band_radius + 1)
+                for bits in combinations(range(end - start), radius)
+            ]
+            for start, end in zip(band_edges, band_edges[1:])
+        ]
+        self._hashes = {}
+        self._histograms = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _band_values(self, dhash):
+        return [(dhash >> shift) & mask for shift, mask in self._bands]
+
+    def add(self, image_id, dhash, histogram):
+        if image_id in self._hashes:
+            self.remove(image_id)
+        self._hashes[image_id] = dhash
+        self._histograms[image_id] = _as_histogram(histogram)
+        for table, band_value in zip(self._tables, self._band_values(dhash)):
+            table.setdefault(band_value, set()).add(image_id)
+
+    def remove(self, image_id):
+        dhash = self._hashes.pop(image_id, None)
+        if dhash is None:
+            return
+        self._histograms.pop(image_id)
+        for table, band_value in zip(self._tables, self._band_values(dhash)):
+            ids = table[band_value]
+            ids.discard(image_id)
+            if len(ids) == 0:
+                del table[band_value]
+
+    def query(self, dhash, histogram, max_distance=None):
+        """
+        :param max_distance: hamming distance limit, cannot exceed the one the index was built for
+        :return: list of (image id, hamming distance) sorted by distance
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        histogram = _as_histogram(histogram)
+
+        candidates = set()
+        for table, band_value, flip_masks in zip(self._tables, self._band_values(dhash), self._flip_masks):
+            for flip_mask in flip_masks:
+                candidates.update(table.get(band_value ^ flip_mask, ()))
+
+        near = []
+        for candidate in candidates:
+            distance = bin(dhash ^ self._hashes[candidate]).count("1")
+            if distance > max_distance:
+                continue
+            if np.abs(self._histograms[candidate] - histogram).sum() > self.max_histogram_distance:
+                continue
+            near.append((candidate, distance))
+        return sorted(near, key=lambda item: (item[1], item[0]))
+
+    def find_near_duplicates(self, image_id, max_distance=None):
+        """
+        :return: list of (image id, hamming distance), empty if the image has no fingerprint
+        """
+        if image_id not in self._hashes:
+            return []
+        return [
+            (near_id, distance)
+            for near_id, distance in self.query(self._hashes[image_id], self._histograms[image_id], max_distance)
+            if near_id != image_id
+        ]
+
+    def near_duplicate_groups(self):
+        """
+        Groups images connected by near duplicate relations, with one query per image and union find
+        :return: list of sorted lists of image ids, only groups with more than one image
+        """
+        parents = {}
+        grouped = set()
+
+        def find(image_id):
+            root = image_id
+            while parents.get(root, root) != root:
+                root = parents[root]
+            while image_id != root:
+                parents[image_id], image_id = root, parents[image_id]
+            return root
+
+        for image_id in self._hashes:
+            for near_id, _ in self.find_near_duplicates(image_id):
+                root, near_root = find(image_id), find(near_id)
+                if root != near_root:
+                    parents[max(root, near_root)] = min(root, near_root)
+                grouped.update((image_id, near_id))
+
+        groups = {}
+        for image_id in grouped:
+            groups.setdefault(find(image_id), []).append(image_id)
+        return sorted(sorted(group) for group in groups.values())
@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from image_store.near_duplicate_index import NearDuplicateIndex
+
+BASE_HASH = 0x0123456789abcdef
+HISTOGRAM = np.full(48, 100, dtype=np.uint8)
+
+
+def _flip(dhash, bits):
+    for bit in bits:
+        dhash ^= 1 << bit
+    return dhash
+
+
+class NearDuplicateIndexTest(unittest.TestCase):
+
+    def test_finds_hashes_within_the_distance(self):
+        index = NearDuplicateIndex()
+        # 6 differing bits spread over all 4 bands, so no band value matches exactly
+        spread = _flip(BASE_HASH, [0, 1, 16, 32, 48, 49])
+        index.add(1, BASE_HASH, HISTOGRAM)
+        index.add(2, _flip(BASE_HASH, [5]), HISTOGRAM.tobytes())
+        index.add(3, spread, HISTOGRAM)
+        self.assertEqual(index.query(BASE_HASH, HISTOGRAM), [(1, 0), (2, 1), (3, 6)])
+        self.assertEqual(index.find_near_duplicates(3), [(1, 6)])
+        self.assertEqual(index.query(BASE_HASH, HISTOGRAM, max_distance=1), [(1, 0), (2, 1)])
+
+    def test_ignores_hashes_beyond_the_distance(self):
+        index = NearDuplicateIndex()
+        index.add(1, _flip(BASE_HASH, [0, 1, 16, 17, 32, 48, 49]), HISTOGRAM)
+        index.add(2, ~BASE_HASH & (2 ** 64 - 1), HISTOGRAM)
+        self.assertEqual(index.query(BASE_HASH, HISTOGRAM), [])
+
+    def test_histogram_filters_matching_hashes(self):
+        index = NearDuplicateIndex()
+        similar, different = HISTOGRAM.copy(), HISTOGRAM.copy()
+        similar[:2] += 32
+        different[:2] += 33
+        index.add(1, BASE_HASH, similar)
+        index.add(2, BASE_HASH, different)
+        self.assertEqual(index.query(BASE_HASH, HISTOGRAM), [(1, 0)])
+
+    def test_removed_and_replaced_images_are_not_found(self):
+        index = NearDuplicateIndex()
+        index.add(1, BASE_HASH, HISTOGRAM)
+        index.add(2, BASE_HASH, HISTOGRAM)
+        index.add(2, ~BASE_HASH & (2 ** 64 - 1), HISTOGRAM)
+        index.remove(1)
+        index.remove(3)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.query(BASE_HASH, HISTOGRAM), [])
+        self.assertEqual(index.find_near_duplicates(1), [])
+
+    def test_groups_connect_chains_of_near_duplicates(self):
+        index = NearDuplicateIndex()
+        # 4 and 1 are 8 bits apart, they are grouped through 2 and 3
+        index.add(4, _flip(BASE_HASH, range(0, 64, 8)), HISTOGRAM)
+        index.add(1, BASE_HASH, HISTOGRAM)
+        index.add(2, _flip(BASE_HASH, range(0, 24, 8)), HISTOGRAM)
+        index.add(3, _flip(BASE_HASH, range(0, 48, 8)), HISTOGRAM)
+        index.add(7, _flip(BASE_HASH, range(1, 64, 2)), HISTOGRAM)
+        index.add(8, _flip(BASE_HASH, range(1, 64, 2)), HISTOGRAM)
+        index.add(9, _flip(BASE_HASH, range(0, 64, 2)), HISTOGRAM)
+        self.assertEqual(index.near_duplicate_groups(), [[1, 2, 3, 4], [7, 8]])
@@ -0,0 +1,84 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+THUMBNAIL_SHAPE = (64, 64, 3)
+FACE_THUMBNAILS_FILE = "face_thumbnails.u8"
+
+
+class PackedThumbnailStore:
+    """
+    Fixed size thumbnails packed into one uint8 file, the thumbnail of face `id` is stored at offset
+    id * stride. Readers memory map the file, so reading a thumbnail neither opens a file nor decodes
+    an image, and batches of consecutive ids are read as a single view. Slots are written once,
+    when the face is created, and the file only grows
+    """
+
+    def __init__(self, path: Path, shape=THUMBNAIL_SHAPE):
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.stride = int(np.prod(self.shape))
+        self._fd = None
+        self._mapping = None
+
+    def __len__(self):
+        try:
+            return self.path.stat().st_size // self.stride
+        except FileNotFoundError:
+            return 0
+
+    def _get_mapping(self, min_slots):
+        """
+        Maps the file again if it grew since the last mapping, views returned before remain valid
+        """
+        if self._mapping is None or len(self._mapping) < min_slots:
+            slots = len(self)
+            if slots < min_slots:
+                return None
+            self._mapping = np.memmap(self.path, dtype=np.uint8, mode="r", shape=(slots,) + self.shape)
+        return self._mapping
+
+    def write(self, face_id, thumbnail):
+        thumbnail = np.ascontiguousarray(thumbnail, dtype=np.uint8)
+        if thumbnail.shape != self.shape:
+            raise ValueError(f"Thumbnail shape {thumbnail.shape} does not match {self.shape}")
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # positional write, other processes see it in their mappings without reopening the file
+        os.pwrite(self._fd, thumbnail.tobytes(), face_id * self.stride)
+
+    def copy(self, source_face_id, target_face_id):
+        thumbnail = self.read(source_face_id)
+        if thumbnail is not None:
+            self.write(target_face_id, thumbnail)
+
+    def read(self, face_id):
+        """
+        :return: read only view into the mapped file, None if the slot is past the end of the file
+        """
+        mapping = self._get_mapping(face_id + 1)
+        return None if mapping is None else mapping[face_id]
+
+    def read_range(self, first_face_id, count):
+        """
+        :return: read only view of count thumbnails starting from first_face_id, without copying
+        """
+        mapping = self._get_mapping(first_face_id + count)
+        return None if mapping is None else mapping[first_face_id:first_face_id + count]
+
+    def read_many(self, face_ids):
+        """
+        :return: array of thumbnails gathered from arbitrary slots
+        """
+        face_ids = np.asarray(face_ids, dtype=np.int64)
+        if len(face_ids) == 0:
+            return np.empty((0,) + self.shape, dtype=np.uint8)
+        mapping = self._get_mapping(int(face_ids.max()) + 1)
+        return None if mapping is None else mapping[face_ids]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._mapping = None
@@ -7,7 +7,8 @@ from typing import List
 class AppConfig:
     def __init__(
             self, monitoring_folders: List[Path], config_dir: Path, db_loc: Path, thumbnails_loc: Path,
-            face_thumbnails_loc: Path, crawler_scan_interval: int, face_extractor_model: Path
+            face_thumbnails_loc: Path, crawler_scan_interval: int, face_extractor_model: Path, hash_workers: int = 4,
+            storage_profile: str = "wal", db_readers: int = 2, preview_cache_mb: int = 2048
     ):
         self.monitoring_folders = monitoring_folders
         self.config_dir = config_dir
@@ -16,6 +17,10 @@ class AppConfig:
         self.face_thumbnails_loc = face_thumbnails_loc
         self.crawler_scan_interval = crawler_scan_interval
         self.face_extractor_model = face_extractor_model
+        self.hash_workers = hash_workers  # threads hashing new images, raise for SSD or network storage
+        self.storage_profile = storage_profile  # key of image_store.datamodel.STORAGE_PROFILES
+        self.db_readers = db_readers  # read only connections serving catalog loads
+        self.preview_cache_mb = preview_cache_mb  # size limit of image previews in thumbnails_loc
 
     def write_config(self, config_file_path):
         configp = configparser.ConfigParser()
@@ -41,6 +46,10 @@ class AppConfig:
         for key in ["config_dir", "db_loc", "thumbnails_loc", "face_thumbnails_loc", "face_extractor_model"]:
             config_dict[key] = Path(config_dict[key])
         config_dict["crawler_scan_interval"] = int(config_dict["crawler_scan_interval"])
+        config_dict["hash_workers"] = int(config_dict.get("hash_workers", 4))
+        config_dict["storage_profile"] = config_dict.get("storage_profile", "wal")
+        config_dict["db_readers"] = int(config_dict.get("db_readers", 2))
+        config_dict["preview_cache_mb"] = int(config_dict.get("preview_cache_mb", 2048))
 
         return cls(
             monitoring_folders=config_dict["monitoring_folders"],
@@ -49,7 +58,11 @@ class AppConfig:
             thumbnails_loc=config_dict["thumbnails_loc"],
             face_thumbnails_loc=config_dict["face_thumbnails_loc"],
             crawler_scan_interval=config_dict["crawler_scan_interval"],
-            face_extractor_model=config_dict["face_extractor_model"]
+            face_extractor_model=config_dict["face_extractor_model"],
+            hash_workers=config_dict["hash_workers"],
+            storage_profile=config_dict["storage_profile"],
+            db_readers=config_dict["db_readers"],
+            preview_cache_mb=config_dict["preview_cache_mb"]
         )
 
     def __repr__(self):
@@ -14,6 +14,7 @@ class Crawler(AbstractWorker):
 
     class InboxTypes(Enum):
         SET_EXISTING_IMAGES = 1  # existing images arrived
+        ADD_EXISTING_IMAGES = 2  # a chunk of existing images arrived, more will follow
 
     class OutboxTypes(Enum):
         DISCOVERED_IMAGES = 1  # sending discovered images
@@ -76,6 +77,8 @@ class Crawler(AbstractWorker):
         if message.descriptor == Crawler.InboxTypes.SET_EXISTING_IMAGES:
             self.__scanned_files__.update(set(message.content))
             self._pause_crawling = False
+        elif message.descriptor == Crawler.InboxTypes.ADD_EXISTING_IMAGES:
+            self.__scanned_files__.update(set(message.content))
 
     def handle_incoming(self):
         try:
@@ -6,7 +6,7 @@ from typing import List
 from analyzer import ImageAnalyzer
 from crawler import Crawler
 from image_store import ImageStore, Image
-from protocol import Message, AbstractWorker, start_worker
+from protocol import Message, AbstractWorker, SharedMemoryPool, start_worker
 
 
 class ProcessManager(AbstractWorker):
@@ -21,16 +21,23 @@ class ProcessManager(AbstractWorker):
 
     class InboxTypes(Enum):
         GET_EXISTING_IMAGES = 1
+        FIND_NEAR_DUPLICATES = 2  # content is an image id
+        GET_NEAR_DUPLICATE_GROUPS = 3
 
     class OutboxTypes(Enum):
         EXISTING_IMAGES = 1
         ADDED_IMAGES = 2
         UPDATED_METADATA = 3
+        EXISTING_IMAGES_END = 4
+        NEAR_DUPLICATES = 5
+        NEAR_DUPLICATE_GROUPS = 6
 
     def __init__(self, config, inbox_queue, outbox_queue):
         self.config = config
         self.inbox_queue = inbox_queue
         self.outbox_queue = outbox_queue
+        # face thumbnails travel from the analyzer to the image store through shared memory
+        self.shared_memory_pool = SharedMemoryPool()
 
         self._create_image_store()
         self._create_image_crawler()
@@ -38,10 +45,16 @@ class ProcessManager(AbstractWorker):
 
         self.message_processing_table = {
             ImageStore.OutboxTypes.EXISTING_IMAGES: self._received_existing_images,
+            ImageStore.OutboxTypes.EXISTING_IMAGES_CHUNK: self._received_existing_images_chunk,
+            ImageStore.OutboxTypes.EXISTING_IMAGES_END: self._received_existing_images_end,
             ImageStore.OutboxTypes.ADDED_IMAGES: self._received_images_added_to_image_store,
             ImageStore.OutboxTypes.UPDATED_METADATA: self._send_updates_to_app,
+            ImageStore.OutboxTypes.NEAR_DUPLICATES: self._received_near_duplicates,
+            ImageStore.OutboxTypes.NEAR_DUPLICATE_GROUPS: self._received_near_duplicate_groups,
             Crawler.OutboxTypes.DISCOVERED_IMAGES: self._received_discovered_images,
             ProcessManager.InboxTypes.GET_EXISTING_IMAGES: self._request_existing_images,
+            ProcessManager.InboxTypes.FIND_NEAR_DUPLICATES: self._request_near_duplicates,
+            ProcessManager.InboxTypes.GET_NEAR_DUPLICATE_GROUPS: self._request_near_duplicate_groups,
             ImageAnalyzer.OutboxTypes.UPDATE_METADATA: self._set_new_metadata,
             ImageAnalyzer.OutboxTypes.FACES_IDENTIFIED: self._set_new_metadata
         }
@@ -49,7 +62,9 @@ class ProcessManager(AbstractWorker):
     def _create_image_store(self):
         self.to_image_store_queue = Queue()
         self.image_store_proc = Process(
-            target=start_worker, args=(ImageStore, self.config, self.to_image_store_queue, self.inbox_queue)
+            target=start_worker, args=(
+                ImageStore, self.config, self.to_image_store_queue, self.inbox_queue, self.shared_memory_pool
+            )
         )
         self.image_store_proc.start()
 
@@ -63,7 +78,9 @@ class ProcessManager(AbstractWorker):
     def _create_image_analyzer(self):
         self.to_image_analyzer_queue = Queue()
         self.image_analyzer_proc = Process(
-            target=start_worker, args=(ImageAnalyzer, self.config, self.to_image_analyzer_queue, self.inbox_queue)
+            target=start_worker, args=(
+                ImageAnalyzer, self.config, self.to_image_analyzer_queue, self.inbox_queue, self.shared_memory_pool
+            )
         )
         self.image_analyzer_proc.start()
 
@@ -80,6 +97,29 @@ class ProcessManager(AbstractWorker):
         self._send_images_for_analysis(message.content)
         self._send_faces_for_analysis(message.content)
 
+    def _received_existing_images_chunk(self, message: Message):
+        # the app, the crawler and the analyzer start working on the first chunk
+        self.outbox_queue.put(
+            Message(ProcessManager.OutboxTypes.EXISTING_IMAGES, content=message.content)
+        )
+        self.to_image_crawler_queue.put(
+            Message(
+                Crawler.InboxTypes.ADD_EXISTING_IMAGES,
+                content=[image.path for image in message.content]
+            )
+        )
+        self._send_images_for_analysis(message.content)
+        self._send_faces_for_analysis(message.content)
+
+    def _received_existing_images_end(self, message: Message):
+        self.outbox_queue.put(
+            Message(ProcessManager.OutboxTypes.EXISTING_IMAGES_END, content=None)
+        )
+        # crawling starts only when every known image is registered, otherwise they would be rediscovered
+        self.to_image_crawler_queue.put(
+            Message(Crawler.InboxTypes.SET_EXISTING_IMAGES, content=[])
+        )
+
     def _received_images_added_to_image_store(self, message: Message):
         self.outbox_queue.put(
             Message(ProcessManager.OutboxTypes.ADDED_IMAGES, content=message.content)
@@ -93,7 +133,27 @@ class ProcessManager(AbstractWorker):
 
     def _request_existing_images(self, message: Message):
         self.to_image_store_queue.put(
-            Message(ImageStore.InboxTypes.GET_EXISTING_IMAGES, content=None)
+            Message(ImageStore.InboxTypes.STREAM_EXISTING_IMAGES, content=None)
+        )
+
+    def _request_near_duplicates(self, message: Message):
+        self.to_image_store_queue.put(
+            Message(ImageStore.InboxTypes.FIND_NEAR_DUPLICATES, content=message.content)
+        )
+
+    def _request_near_duplicate_groups(self, message: Message):
+        self.to_image_store_queue.put(
+            Message(ImageStore.InboxTypes.GET_NEAR_DUPLICATE_GROUPS, content=None)
+        )
+
+    def _received_near_duplicates(self, message: Message):
+        self.outbox_queue.put(
+            Message(ProcessManager.OutboxTypes.NEAR_DUPLICATES, content=message.content)
+        )
+
+    def _received_near_duplicate_groups(self, message: Message):
+        self.outbox_queue.put(
+            Message(ProcessManager.OutboxTypes.NEAR_DUPLICATE_GROUPS, content=message.content)
         )
 
     def _set_new_metadata(self, message: Message):
@@ -102,9 +162,11 @@ class ProcessManager(AbstractWorker):
         )
 
     def _send_images_for_analysis(self, images: List[Image]):
-        not_analyzed = [
-            image for image in images if image.faces_detected is False or image.tags_detected is False
-        ]
+        # one copy of identical content is analyzed, the image store copies results to the others
+        not_analyzed = list({
+            image.md5: image for image in reversed(images)
+            if image.faces_detected is False or image.tags_detected is False or image.fingerprinted is False
+        }.values())
         if len(not_analyzed) > 0:
             self.to_image_analyzer_queue.put(
                 Message(ImageAnalyzer.InboxTypes.ANALYZE_NEW_IMAGES, content=not_analyzed)
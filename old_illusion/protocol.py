@@ -1,6 +1,11 @@
+import multiprocessing
+import struct
 from abc import abstractmethod
 from enum import Enum
-from multiprocessing import Queue
+from multiprocessing import Queue, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
 
 from old_illusion.app_config import AppConfig
 
@@ -11,6 +16,138 @@ class Message:
         self.content = content
 
 
+class SharedArray:
+    """
+    Handle of an array placed in a shared memory segment by SharedMemoryPool. Only the handle is pickled
+    when it is sent through a queue, the receiver maps the same memory
+    """
+    __slots__ = ("segment_name", "shape", "dtype", "offset")
+
+    def __init__(self, segment_name, shape, dtype, offset):
+        self.segment_name = segment_name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.offset = offset
+
+    def __reduce__(self):
+        return SharedArray, (self.segment_name, self.shape, self.dtype, self.offset)
+
+    def __repr__(self):
+        return f"SharedArray({self.segment_name}, shape={self.shape}, dtype={self.dtype})"
+
+
+class SharedMemoryPool:
+    """
+    Shared memory segments for passing arrays between worker processes without pickling them.
+    Every segment starts with a reference count, one per handle given out, which is changed under a lock
+    shared by all processes. The consumer of a handle calls release when it does not need the array anymore.
+    Segments are owned by the process that created them, it reuses segments whose count dropped to zero
+    and unlinks them when more than max_free_segments are unused
+    """
+    _HEADER = struct.Struct("q")  # reference count
+    _ALIGNMENT = 64
+    MIN_SEGMENT_SIZE = 64 * 1024
+
+    def __init__(self, max_free_segments=8):
+        self.max_free_segments = max_free_segments
+        self._lock = multiprocessing.Lock()
+        # workers started after this share one resource tracker, so a segment mapped by a consumer is not
+        # unlinked when the consumer exits, and segments leaked by a crashed worker are removed on shutdown
+        resource_tracker.ensure_running()
+        self._created = {}  # segments created by this process
+        self._attached = {}  # segments of other processes mapped by this process
+
+    def __getstate__(self):
+        # segments are not inherited, every process maps the ones it receives handles to
+        return self.max_free_segments, self._lock
+
+    def __setstate__(self, state):
+        self.max_free_segments, self._lock = state
+        self._created = {}
+        self._attached = {}
+
+    def _get_ref_count(self, segment):
+        return self._HEADER.unpack_from(segment.buf, 0)[0]
+
+    def _set_ref_count(self, segment, ref_count):
+        self._HEADER.pack_into(segment.buf, 0, ref_count)
+
+    def _claim_segment(self, size, ref_count):
+        """
+        Reuses an unused segment of this process that is large enough or creates a new one
+        """
+        with self._lock:
+            free = [segment for segment in self._created.values() if self._get_ref_count(segment) == 0]
+            claimed = next((segment for segment in free if segment.size >= size), None)
+            if claimed is not None:
+                self._set_ref_count(claimed, ref_count)
+                free.remove(claimed)
+            for segment in free[self.max_free_segments:]:
+                del self._created[segment.name]
+                segment.close()
+                segment.unlink()
+        if claimed is None:
+            # power of two sizes make it likely that a segment fits the next batch
+            claimed = SharedMemory(create=True, size=max(1 << (size - 1).bit_length(), self.MIN_SEGMENT_SIZE))
+            self._set_ref_count(claimed, ref_count)
+            self._created[claimed.name] = claimed
+        return claimed
+
+    def _get_segment(self, segment_name):
+        segment = self._created.get(segment_name) or self._attached.get(segment_name)
+        if segment is None:
+            segment = SharedMemory(name=segment_name)
+            self._attached[segment_name] = segment
+        return segment
+
+    def share(self, arrays):
+        """
+        Copies arrays into one segment
+        :return: list of SharedArray, every handle has to be released once
+        """
+        arrays = [np.ascontiguousarray(array) for array in arrays]
+        offsets = []
+        size = self._ALIGNMENT
+        for array in arrays:
+            offsets.append(size)
+            size += -(-array.nbytes // self._ALIGNMENT) * self._ALIGNMENT
+
+        segment = self._claim_segment(size, ref_count=len(arrays))
+        handles = []
+        for array, offset in zip(arrays, offsets):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, offset=offset)[...] = array
+            handles.append(SharedArray(segment.name, array.shape, array.dtype.str, offset))
+        return handles
+
+    def get_array(self, handle: SharedArray):
+        """
+        :return: array backed by the shared memory, valid until the handle is released
+        """
+        segment = self._get_segment(handle.segment_name)
+        return np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=segment.buf, offset=handle.offset)
+
+    def release(self, handle: SharedArray):
+        segment = self._get_segment(handle.segment_name)
+        with self._lock:
+            ref_count = self._get_ref_count(segment) - 1
+            self._set_ref_count(segment, ref_count)
+        if ref_count == 0 and handle.segment_name in self._attached:
+            try:
+                segment.close()
+                del self._attached[handle.segment_name]
+            except BufferError:
+                pass  # an array of the segment is still referenced, the mapping is closed with the pool
+
+    def close(self):
+        for segment in self._attached.values():
+            segment.close()
+        for segment in self._created.values():
+            segment.close()
+            segment.unlink()
+        self._attached = {}
+        self._created = {}
+
+
 class AbstractWorker:
     config = None
     inbox_queue = None